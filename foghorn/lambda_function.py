@@ -1,4 +1,6 @@
 import requests
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape as xml_escape
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import json
@@ -7,7 +9,20 @@ import hmac
 import hashlib
 import logging
 import os
-from bs4 import BeautifulSoup
+import re
+import time
+import tarfile
+import threading
+import functools
+import collections
+import copy
+import posixpath
+import sqlite3
+import heapq
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup, Doctype
+from lxml import etree
 
 ## Inputs / Constants
 # 'https://api.github.com/repos/foghorn-systems/docs.foghorn-systems.com'
@@ -23,6 +38,77 @@ category_map = {}
 section_map = {}
 article_map = {}
 xml_parser = "xml"
+xml_converter = os.environ.get('xml_converter', 'soup')  # or 'xslt'
+xslt_local = threading.local()
+topic_doctype = 'topic PUBLIC "-//OASIS//DTD DITA Topic//EN" "topic.dtd"'
+github_concurrency = int(os.environ.get('github_concurrency', 8))
+github_compare_max_files = 300  # the compare api lists at most 300 files
+github_cache_dir = os.environ.get('github_cache_dir', '/tmp/github_cache')
+github_cache_max_bytes = int(
+    os.environ.get('github_cache_max_bytes', 128 * 1024 * 1024))
+conversion_cache_dir = os.environ.get(
+    'conversion_cache_dir', '/tmp/conversion_cache')
+conversion_cache_max_bytes = int(
+    os.environ.get('conversion_cache_max_bytes', 64 * 1024 * 1024))
+conversion_cache_entries = int(
+    os.environ.get('conversion_cache_entries', 500))
+converter_version = '4'  # bump whenever the converted html changes
+publish_record_dir = os.environ.get(
+    'publish_record_dir', '/tmp/publish_records')
+article_fingerprints = {}  # Zendesk article id -> fingerprint of its body
+run_summary = collections.Counter()
+ditamap_indexes = {}
+zendesk_concurrency = int(os.environ.get('zendesk_concurrency', 4))
+http_pool_size = int(os.environ.get(
+    'http_pool_size', max(github_concurrency, zendesk_concurrency, 10)))
+http_connect_timeout = float(os.environ.get('http_connect_timeout', 5))
+http_read_timeout = float(os.environ.get('http_read_timeout', 60))
+zendesk_rate_limit = int(os.environ.get('zendesk_rate_limit', 200))  # /min
+zendesk_max_attempts = int(os.environ.get('zendesk_max_attempts', 5))
+zendesk_page_size = 100  # largest page of the cursor paginated listings
+zendesk_catalog_dir = os.environ.get(
+    'zendesk_catalog_dir', '/tmp/zendesk_catalog')
+zendesk_catalog_max_age = int(
+    os.environ.get('zendesk_catalog_max_age', 24 * 60 * 60))  # seconds
+zendesk_catalog_lock = threading.Lock()
+single_flight_locks = {}
+single_flight_lock = threading.Lock()
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+# per host authentication, headers and retry settings of http_session
+http_host_defaults = {
+    urlparse(github_url).netloc: {
+        'auth': (gh_username, gh_token),
+        'headers': {'Accept': 'application/vnd.github.v3+json'},
+        'retry': {'backoff_factor': 1, 'status_forcelist': (500, 502, 503,
+                                                            504)},
+    },
+    urlparse(zendesk_url).netloc: {
+        'auth': (zendesk_username, zendesk_password),
+        'headers': {'Content-Type': 'application/json'},
+        # 429 responses are handled by zendesk_send and the rate limiter
+        'retry': {'backoff_factor': 2, 'status_forcelist': (500, 502, 503,
+                                                            504)},
+    },
+}
+state_backend = os.environ.get('state_backend', 'sqlite')
+state_store_path = os.environ.get('state_store_path', '/tmp/sync_state.db')
+shard_backend = os.environ.get(
+    'shard_backend',
+    'lambda' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else 'process')
+shard_function_name = os.environ.get(
+    'shard_function_name', os.environ.get('AWS_LAMBDA_FUNCTION_NAME'))
+shard_timeout = int(os.environ.get('shard_timeout', 900))  # seconds
+shard_margin = int(os.environ.get('shard_margin', 60))  # seconds
+run_deadline = None  # time after which a shard stops publishing
+zendesk_max_deletes = int(os.environ.get('zendesk_max_deletes', 25))
+summary_lock = threading.Lock()
+dita_tree = {}  # DITA relative path -> git blob sha (bulk mode)
+dita_files = {}  # DITA relative path -> decoded contents (snapshot mode)
+dita_shas = {}  # DITA relative path -> git blob sha of the fetched file
+dita_titles = {}  # DITA relative path -> topic title
+resolved_conrefs = {}  # (path, id) -> (resolved element, source paths)
 
 # backend authentication
 # check the SHA-1 encryption w/ secret matches
@@ -55,6 +141,7 @@ def requests_retry_session(
     backoff_factor=15,
     status_forcelist=(413, 429, 503, 500, 502, 504),
     session=None,
+    pool_size=10,
 ):
     session = session or requests.Session()
     retry = Retry(
@@ -64,11 +151,38 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size,
+                          pool_maxsize=pool_size)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
+# requests session with default connect and read timeouts
+
+
+class TimeoutSession(requests.Session):
+    def request(self, *args, **kwargs):
+        kwargs.setdefault(
+            'timeout', (http_connect_timeout, http_read_timeout))
+        return super(TimeoutSession, self).request(*args, **kwargs)
+
+# returns the keep-alive session of a host, created on first use and
+# reused by every thread and by later warm invocations
+
+
+def http_session(url):
+    host = urlparse(url).netloc
+    with http_sessions_lock:
+        if host not in http_sessions:
+            session = TimeoutSession()
+            defaults = http_host_defaults.get(host, {})
+            session.auth = defaults.get('auth')
+            session.headers.update(defaults.get('headers', {}))
+            http_sessions[host] = requests_retry_session(
+                session=session, pool_size=http_pool_size,
+                **defaults.get('retry', {}))
+        return http_sessions[host]
+
 
 # process invoker
 def lambda_handler(event, context):
@@ -93,6 +207,42 @@ def lambda_handler(event, context):
     if verbose_logging:
         logger.info(data_received)
 
+    # bulk mode lists the DITA tree once and fetches files by blob sha
+    try:
+        bulk = event["queryStringParameters"]['bulk']
+    except(KeyError, TypeError):
+        bulk = False
+
+    # snapshot mode downloads the repository archive once for the whole run
+    try:
+        snapshot = event["queryStringParameters"]['snapshot']
+    except(KeyError, TypeError):
+        snapshot = False
+
+    run_summary.clear()
+
+    # warm containers revalidate github files through the etag cache
+    github_get.memo.clear()
+    dita_tree.clear()
+    dita_files.clear()
+    dita_shas.clear()
+    dita_titles.clear()
+    conref_index.memo.clear()
+    resolved_conrefs.clear()
+
+    # Zendesk listings are reloaded every run, articles incrementally
+    for listing in (list_zendesk_categories, list_zendesk_sections,
+                    list_zendesk_articles):
+        listing.memo.clear()
+    category_map.clear()
+    section_map.clear()
+    article_map.clear()
+
+    if snapshot:
+        load_dita_archive()
+    elif bulk:
+        load_dita_tree()
+
     # retrieve the full dita map
     ditamap = git_dita_map()
 
@@ -103,505 +253,1746 @@ def lambda_handler(event, context):
     except(KeyError, TypeError):
         update_all = False
 
-    if update_all:
+    # if delete allowed - delete unmapped categories/sections/articles
+    try:
+        delete_enabled = event["queryStringParameters"]['delete']
+    except(KeyError, TypeError):
+        delete_enabled = False
 
-        # review every file in the map
-        for category in ditamap['children']:
+    # plan only - report the Zendesk writes without applying them
+    try:
+        plan_only = event["queryStringParameters"]['plan-only']
+    except(KeyError, TypeError):
+        plan_only = False
 
-            category_name = category['title']
+    # sharded full runs fan the articles out to parallel workers
+    try:
+        shard_count = int(event["queryStringParameters"]['shards'])
+    except(KeyError, TypeError, ValueError):
+        shard_count = 0
+    shard = event.get('shard')
+
+    # a shard publishes within its share of the Zendesk rate limit and of
+    # the coordinator's time
+    global run_deadline
+    run_deadline = shard['deadline'] if shard else None
+    zendesk_rate_limiter.set_share(shard['rate_share'] if shard else 1)
+
+    upserts = []
+    map_deletes = []
+    if update_all and shard_count > 1 and not shard and not plan_only:
+        run_shards(ditamap, shard_count, event, context)
+    elif update_all:
+
+        articles = list(ditamap_articles(ditamap))
+
+        # a shard only publishes its own articles, with the catalog shared
+        # by the coordinator
+        if shard:
+            hrefs = set(shard['hrefs'])
+            articles = [a for a in articles if a[3] in hrefs]
+            load_shard_catalog(shard['catalog'])
+
+        # start fetching every article while the first ones are processed
+        prefetch_dita_files([a[3] for a in articles])
+
+        # convert every file in the map
+        for article in articles:
+            if past_run_deadline():
+                count_summary('articles_deferred')
+                continue
+            upsert = prepare_dita_article(*article)
+            if upsert:
+                upserts.append(upsert)
+    else:
 
-            for section in category['children']:
+        # review the files changed by the push from the webhook
+        if 'commits' in data_received:
 
-                if 'children' in section:
+            # identify impacted files, once each at the after sha
+            impacted_files = push_changed_files(data_received)
+            if verbose_logging:
+                logger.info(impacted_files)
+
+            # get file contents
+            github_prefetch([f['contents_url'] for f in impacted_files
+                             if '.ditamap' not in f['filename']])
+            for f in impacted_files:
+
+                # .ditamap files do not need to be checked
+                # they are handled through the get_dita_map function
+                if '.ditamap' not in f['filename']:
+
+                    contents_url = f['contents_url']
+                    if verbose_logging:
+                        logger.info(contents_url)
+                    content_json = github_get(contents_url)
+                    content = decode_content(content_json['content'])
+                    article_href = dita_path(contents_url)
+                    dita_shas[article_href] = content_json.get('sha')
+
+                    # check if each file is mapped
+                    file_mapping = get_file_mapping(contents_url, ditamap)
+                    if file_mapping:
+
+                        # parse once for every step below
+                        content = parse_dita(content)
+
+                        # get article title
+                        article_title = file_mapping[2] or \
+                            get_article_title(content)
+
+                        # replace conrefs
+                        update_conrefs(content, base_path=article_href)
+
+                        # convert article content to html
+                        converted_content = convert_xml(content)
+
+                        # identify category name & section name
+                        category_name = file_mapping[0]
+                        section_name = file_mapping[1] or category_name
+
+                        # handle updated .dita file
+                        upserts.append((
+                            category_name, section_name, article_title,
+                            converted_content, article_href))
+
+            # apply ditamap changes against the sync state
+            if any('.ditamap' in f['filename'] for f in impacted_files):
+                changed_articles, map_deletes = diff_ditamap(ditamap)
+                published = set(u[4] for u in upserts)
+                changed_articles = [a for a in changed_articles
+                                    if a[3] not in published]
+                prefetch_dita_files([a[3] for a in changed_articles])
+                for article in changed_articles:
+                    upsert = prepare_dita_article(*article)
+                    if upsert:
+                        upserts.append(upsert)
+
+            # re-publish the topics that pull in a changed file via conrefs
+            changed = set(dita_path(f['contents_url'])
+                          for f in impacted_files)
+            dependents = conref_dependents(changed) - \
+                set(u[4] for u in upserts)
+            prefetch_dita_files(dependents)
+            for article_href in sorted(dependents):
+                file_mapping = get_file_mapping(article_href, ditamap)
+                if file_mapping:
+                    upsert = prepare_dita_article(
+                        file_mapping[0], file_mapping[1] or file_mapping[0],
+                        file_mapping[2], article_href)
+                    if upsert:
+                        upserts.append(upsert)
 
-                    for article in section['children']:
-
-                        section_name = section['title']
-                        article_title = article['title']
-                        article_href = article['href']
-                        if '.ditamap' not in article_href:
-                            raw_json = github_get(
-                                github_url + '/contents/DITA/' + article_href)
-                            article_content = decode_content(
-                                raw_json['content'])
-                            article_content = update_conrefs(
-                                article_content)  # replace conrefs
-                            try:
-                                # convert article content to html
-                                converted_content = convert_xml(
-                                    article_content)
-                            except BaseException:
-                                log('xml conversion error: ' + article_href)
-                                continue
-                            create_or_update_zendesk_article(
-                                category_name, section_name, article_title, 
-                                converted_content)
-
-                else:
-
-                    section_name = category_name
-                    article_title = section['title']
-                    article_href = section['href']
-                    if '.ditamap' not in article_href:
-                        raw_json = github_get(
-                            github_url + '/contents/DITA/' + article_href)
-                        article_content = decode_content(raw_json['content'])
-                        article_content = update_conrefs(
-                            article_content)  # replace conrefs
-                        try:
-
-                            # convert article content to html
-                            converted_content = convert_xml(article_content)
-                        except BaseException:
-                            log('xml conversion error: ' + article_href)
-                            continue
-                        create_or_update_zendesk_article(
-                            category_name, section_name, article_title, converted_content)
-    else:
+    if delete_enabled:
+        resolve_ditamap_titles(ditamap)
+
+    # compare against the whole catalog when most of it is touched
+    # shards get the catalog from the coordinator
+    if (update_all or delete_enabled) and not shard:
+        warm_zendesk_catalog()
+
+    # plan every Zendesk write, then apply them in dependency order
+    plan = plan_zendesk_sync(upserts, ditamap if delete_enabled else None,
+                             map_deletes)
+    if plan_only:
+        log('sync plan', plan['api_calls'])
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"status": "planned",
+                                "plan": describe_sync_plan(plan)})
+        }
+    execute_sync_plan(plan)
 
-        # review each commit from the webhook
-        if 'commits' in data_received:
-            commits = data_received['commits']
-            for commit in commits:
+    # later pushes diff their ditamap against the sync state once a full
+    # run has published every mapped article from this state store
+    # sharded runs publish from the shards' own state stores
+    if update_all and not shard and shard_count <= 1:
+        sync_state.set_value('full_sync_at', int(time.time()))
 
-                # fetch the commit
-                commit_id = commit['id']
-                commit_url = github_url + '/commits/' + commit_id
-                full_commit = github_get(url=commit_url)
-                if verbose_logging:
-                    logger.info(full_commit)
+    log('run summary', json.dumps(run_summary, sort_keys=True))
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"status": "complete", "summary": run_summary})
+    }
 
-                # identify impacted files
-                impacted_files = full_commit['files']
+# list (category, section, title, href) for every article in the ditamap
 
-                # get file contents
-                for f in impacted_files:
 
-                    # .ditamap files do not need to be checked
-                    # they are handled through the get_dita_map function
-                    if '.ditamap' not in f['filename']:
+def ditamap_articles(ditamap):
+    for category in ditamap['children']:
+        category_name = category['title']
+        for section in category['children']:
+            if 'children' in section:
+                for article in section['children']:
+                    yield (category_name, section['title'], article['title'],
+                           article['href'])
+            else:
+                # articles directly under a category share its name
+                yield (category_name, category_name, section['title'],
+                       section['href'])
+
+# split a full run into shards and publish them in parallel workers
+# categories and sections are created up front and shared with every shard
+# along with the articles of its sections, so shards neither list the help
+# center again nor create categories and sections twice
+# shards split the Zendesk rate limit between them and stop publishing
+# before the coordinator runs out of time, articles left over are counted
+# as deferred, their summaries are added to this run's
+
+
+def run_shards(ditamap, shard_count, event, context=None):
+    parameters = event["queryStringParameters"]
+    articles = list(ditamap_articles(ditamap))
+    shards = [shard for shard in partition_articles(
+        articles, shard_count, parameters.get('shard-by') == 'category')
+        if shard]
+    prepare_shard_catalog(articles)
+
+    budget = shard_timeout
+    if context:
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000.0
+                     - shard_margin)
+    budget = max(budget, 1)
+    deadline = time.time() + budget
+    parameters = dict((k, v) for k, v in parameters.items()
+                      if k in ('updateall', 'bulk', 'snapshot'))
+    events = [{'shard': {'index': i, 'hrefs': [a[3] for a in shard],
+                         'catalog': shard_catalog(shard),
+                         'rate_share': 1.0 / len(shards),
+                         'deadline': deadline},
+               'queryStringParameters': parameters}
+              for i, shard in enumerate(shards)]
+
+    started = time.time()
+    results = shard_backends[shard_backend](events, budget + shard_margin / 2)
+    for shard_event, result in zip(events, results):
+        try:
+            summary = json.loads(result['body'])['summary']
+        except(KeyError, TypeError, ValueError):
+            report_error(run_shards.__name__, shard_event['shard']['index'],
+                         result)
+            count_summary('shards_failed')
+            continue
+        for key, n in summary.items():
+            if not key.endswith('_ms'):
+                count_summary(key, n)
+        count_summary('shards')
+    count_summary('shards_ms', int((time.time() - started) * 1000))
+    log(run_shards.__name__, len(events), shard_backend)
 
-                        contents_url = f['contents_url']
-                        if verbose_logging:
-                            logger.info(contents_url)
-                        content_json = github_get(url=contents_url)
-                        content = decode_content(content_json['content'])
+# split articles into shards of about equal cost, one article each or, by
+# category, every article of a category in the same shard
+# units are placed largest first on the least loaded shard
 
-                        # check if each file is mapped
-                        file_mapping = get_file_mapping(contents_url,
-                                                        ditamap)
-                        if file_mapping:
 
-                            # get article title
-                            article_title = get_article_title(content)
+def partition_articles(articles, shard_count, by_category=False):
+    units = collections.OrderedDict()
+    for a in articles:
+        units.setdefault(a[0] if by_category else a[3], []).append(a)
+    shards = [[] for i in range(shard_count)]
+    loads = [(0, i) for i in range(shard_count)]
+    for unit in sorted(units.values(), key=len, reverse=True):
+        load, i = heapq.heappop(loads)
+        shards[i].extend(unit)
+        heapq.heappush(loads, (load + len(unit), i))
+    return shards
 
-                            # replace conrefs
-                            content = update_conrefs(content)
+# load the catalog and create every category and section of the articles
 
-                            # convert article content to html
-                            converted_content = convert_xml(content)
 
-                            # identify category name & section name
-                            category_name = file_mapping[0]
-                            section_name = file_mapping[1] or category_name
+def prepare_shard_catalog(articles):
+    warm_zendesk_catalog()
+    run_parallel(get_or_create_zendesk_category, set(a[0] for a in articles))
+    run_parallel(lambda s: get_or_create_zendesk_section(
+        zendesk_category_id(s[0]), s[1]),
+        set((a[0], a[1]) for a in articles if zendesk_category_id(a[0])))
 
-                            # handle updated .dita file
-                            create_or_update_zendesk_article(
-                                category_name, section_name, article_title,
-                                converted_content)
+# catalog snapshot handed to a shard, every category and section and the
+# articles of the shard's sections
 
-    # if delete allowed - delete unmapped categories/sections/articles
+
+def shard_catalog(articles):
+    section_ids = set(zendesk_section_id(zendesk_category_id(a[0]), a[1])
+                      for a in articles)
+    return {'categories': dict(category_map),
+            'sections': dict((str(category_id), sections)
+                             for category_id, sections in section_map.items()),
+            'articles': [a for a in list_zendesk_articles()
+                         if a['section_id'] in section_ids]}
+
+# seed the lookup maps and listings of a shard with the coordinator's
+# catalog, the coordinator created every category and section already
+
+
+def load_shard_catalog(catalog):
+    category_map.update(catalog['categories'])
+    for category_id, sections in catalog['sections'].items():
+        section_map.setdefault(int(category_id), {}).update(sections)
+    for a in catalog['articles']:
+        article_map.setdefault(a['section_id'], {})[a['title']] = a['id']
+        article_fingerprints[a['id']] = a['body_hash']
+    list_zendesk_categories.prime((), LazyListing(iter([])))
+    list_zendesk_sections.prime((), LazyListing(iter([])))
+    list_zendesk_articles.prime((), LazyListing(iter(catalog['articles'])))
+
+# whether a shard ran out of its share of the coordinator's time
+
+
+def past_run_deadline():
+    return run_deadline is not None and time.time() > run_deadline
+
+# run every shard as a synchronous invocation of this function, the
+# invocations run concurrently, returns their responses in order
+# responses are awaited for at most timeout seconds, the shards stop
+# publishing at their deadline before that
+
+
+def invoke_lambda_shards(events, timeout):
+    import boto3
+    from botocore.config import Config
+
+    # a shard is never retried, a retry could publish it twice
+    client = boto3.client('lambda', config=Config(
+        read_timeout=timeout, retries={'max_attempts': 0}))
+
+    def invoke(shard_event):
+        try:
+            r = client.invoke(FunctionName=shard_function_name,
+                              InvocationType='RequestResponse',
+                              Payload=json.dumps(shard_event).encode('utf-8'))
+            return json.loads(r['Payload'].read().decode('utf-8'))
+        except Exception as e:
+            return {'errorMessage': str(e)}
+    with ThreadPoolExecutor(max_workers=len(events) or 1) as executor:
+        return list(executor.map(invoke, events))
+
+# run every shard in a local worker process, returns their responses in
+# order
+# workers are spawned, forked ones would inherit the thread pools and locks
+
+
+def run_process_shards(events, timeout):
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=len(events) or 1) as pool:
+        try:
+            return pool.map_async(run_shard, events).get(timeout)
+        except(multiprocessing.TimeoutError):
+            return [{'errorMessage': 'shard timed out'}] * len(events)
+
+# entry point of a local shard worker, failures are returned as a response
+
+
+def run_shard(shard_event):
     try:
-        delete_enabled = event["queryStringParameters"]['delete']
-    except(KeyError, TypeError):
-        delete_enabled = False
+        return lambda_handler(shard_event, None)
+    except Exception as e:
+        return {'errorMessage': str(e)}
+
+
+shard_backends = {'lambda': invoke_lambda_shards,
+                  'process': run_process_shards}
+
+# compare the ditamap against what the sync state says was published
+# returns the (category, section, title, href) articles that are new,
+# moved, retitled or never published, and the (obj_type, id) pairs of
+# published items the map no longer lists, items inside a deleted category
+# or section are left out as Zendesk deletes them with it
+# writes that failed or deletes that were blocked leave the sync state as
+# it was, so the next diff finds them again
+# titles taken from the topic itself are compared when the topic changes
+
+
+def diff_ditamap(ditamap):
+    if sync_state.get_value('full_sync_at') is None:
+        log(diff_ditamap.__name__, 'no full sync yet, run updateall')
+        return [], []
+    records = sync_state.records()
+    current = list(ditamap_articles(ditamap))
+    changed = []
+    for a in current:
+        state = records.get(dita_path(a[3]))
+        if not state or (state['category_key'], state['section_key']) != \
+                (title_to_key(a[0]), title_to_key(a[1])) or \
+                (a[2] is not None and a[2] != state['title']):
+            changed.append(a)
+
+    mapped = set(dita_path(a[3]) for a in current)
+    categories = set(title_to_key(a[0]) for a in current)
+    sections = set((title_to_key(a[0]), title_to_key(a[1])) for a in current)
+    deletes = []
+    for href, state in records.items():
+        if href in mapped:
+            continue
+        category_key = state['category_key']
+        section_key = (category_key, state['section_key'])
+        if category_key not in categories:
+            item = ('categories', state['category_id'])
+        elif section_key not in sections:
+            item = ('sections', state['section_id'])
+        else:
+            item = ('articles', state['article_id'])
+        if item not in deletes:
+            deletes.append(item)
+    log(diff_ditamap.__name__, len(changed), len(deletes))
+    return changed, deletes
 
-    if delete_enabled:
+# topics depending on any of the given files through conrefs
 
-        category_dict = {}
 
-        # delete extra categories
-        for c in list_zendesk_categories():
-            category_dict[c['id']] = c['name']
-            if not is_category_mapped(ditamap, c['name']):
-                delete_zendesk_item('categories', c['id'])
+def conref_dependents(paths):
+    dependents = set()
+    for path in paths:
+        dependents.update(sync_state.dependents(path))
+    log(conref_dependents.__name__, sorted(paths), sorted(dependents))
+    return dependents
 
-        # delete extra sections
-        for s in list_zendesk_sections():
-            category_name = category_dict[s['category_id']]
-            if not is_section_mapped(ditamap, category_name, s['name']):
-                delete_zendesk_item('sections', s['id'])
-
-            # delete extra articles
-            for a in list_zendesk_articles():
-                if a['section_id'] == s['id']:
-                    section_name = s['name']
-                    if not is_article_mapped(
-                            ditamap, category_name, section_name, a['title']):
-                        delete_zendesk_item('articles', a['id'])
+# fetch and convert a single mapped .dita file
+# returns the (category, section, title, html, href) upsert, None on failure
 
-    return {
-        "statusCode": 200,
-        "body": "complete"
-    }
+
+def prepare_dita_article(category_name, section_name, article_title,
+                         article_href):
+    if '.ditamap' in article_href:
+        return None
+    try:
+        topic_title, converted_content = convert_dita_file(article_href)
+    except BaseException:
+        log('xml conversion error: ' + article_href)
+        return None
+
+    # titles missing from the ditamap come from the topic itself
+    return (category_name, section_name, article_title or topic_title,
+            converted_content, dita_path(article_href))
+
+# convert a .dita file to html, returns its (title, html)
+# unchanged topics come from the cache, entries are keyed by the topic's
+# path and blob sha, the blob sha of every conref source it pulled in and
+# the converter version
+# conrefs resolve relative to the topic, so equal files in other folders
+# get their own entries
+
+
+def convert_dita_file(path):
+    path = dita_path(path)
+    topic = path + '@' + dita_file_sha(path)
+    key = conversion_cache_key(topic)
+    converted = conversion_cache.get(key) if key else None
+    if converted is None:
+        # the topic is parsed once, then converted in place
+        conref_paths = []
+        soup = parse_dita(get_dita_file(path))
+        title = get_article_title(soup)
+        update_conrefs(soup, conref_paths, path)  # replace conrefs
+        converted = {'title': title, 'html': convert_xml(soup)}
+
+        conversion_cache.set('conrefs:' + topic, sorted(set(conref_paths)))
+        conversion_cache.set(conversion_cache_key(topic), converted)
+    dita_titles[path] = converted['title']
+    return converted['title'], converted['html']
+
+# returns the conversion cache key of a topic, given as its path@blob sha,
+# None if it was never converted
+
+
+def conversion_cache_key(topic):
+    conref_paths = conversion_cache.get('conrefs:' + topic)
+    if conref_paths is None:
+        return None
+    prefetch_dita_files(conref_paths)
+    parts = [converter_version, xml_converter, topic]
+    for conref_path in conref_paths:
+        try:
+            parts.append(conref_path + '@' + dita_file_sha(conref_path))
+        except(KeyError, TypeError):
+            parts.append(conref_path + '@missing')
+    return 'html:' + hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
 
 # memoize stores function results for faster processing
+# concurrent calls with the same arguments wait for a single evaluation
 
 
 class Memoize:
     def __init__(self, f):
         self.f = f
         self.memo = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        functools.update_wrapper(self, f)
 
     def __call__(self, *args):
-        if args not in self.memo:
+        with self.lock:
+            if args in self.memo:
+                return self.memo[args]
+            in_flight = self.pending.get(args)
+            if not in_flight:
+                in_flight = self.pending[args] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            in_flight.wait()
+            if args in self.memo:
+                return self.memo[args]
+            return self(*args)  # the first evaluation raised, try again
+        try:
             self.memo[args] = self.f(*args)
+        finally:
+            with self.lock:
+                del self.pending[args]
+            in_flight.set()
         return self.memo[args]
 
+    def prime(self, args, value):
+        with self.lock:
+            return self.memo.setdefault(args, value)
+
+# size bounded json store on disk, it survives warm invocations
+# the least recently used entries are evicted first
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)  # mark as recently used
+            return value
+        except(IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        path = self.path(key)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+            written = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except(IOError, OSError) as e:
+            report_error(DiskCache.__name__, self.directory, str(e))
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = self.disk_usage()[0]
+            else:
+                self.size += written
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def disk_usage(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except(OSError):
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return sum(e[1] for e in entries), entries
+
+    # shrink to 90% of the limit, oldest entries first
+    def evict(self):
+        self.size, entries = self.disk_usage()
+        for mtime, size, name in sorted(entries):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                self.size -= size
+            except(OSError):
+                continue
+
+# least recently used cache kept in memory and backed by a DiskCache
+
+
+class TieredCache:
+    def __init__(self, directory, max_bytes, max_entries):
+        self.memory = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.disk = DiskCache(directory, max_bytes)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        value = self.disk.get(key)
+        if value is not None:
+            self.remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self.remember(key, value)
+        self.disk.set(key, value)
+
+    def remember(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+# sync state kept between runs, one record per published DITA href
+# records hold the Zendesk category, section and article ids the href was
+# published to, the fingerprint of the last body sent and the blob sha of
+# the source file
+# it also keeps which topics pull in each file through conrefs and json
+# values such as the time of the last full sync
+# backends implement get, records, put, forget, forget_item,
+# set_dependencies, dependents, get_value and set_value, see
+# state_backends
+
+
+class SqliteStateStore:
+    fields = ('category_key', 'category_id', 'section_key', 'section_id',
+              'article_id', 'title', 'content_hash', 'blob_sha',
+              'updated_at')
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS sync_state ('
+                       'href TEXT PRIMARY KEY, category_key TEXT, '
+                       'category_id INTEGER, section_key TEXT, '
+                       'section_id INTEGER, article_id INTEGER, '
+                       'title TEXT, content_hash TEXT, blob_sha TEXT, '
+                       'updated_at INTEGER)')
+            db.execute('CREATE TABLE IF NOT EXISTS conref_deps ('
+                       'source TEXT, topic TEXT, '
+                       'PRIMARY KEY (source, topic))')
+            db.execute('CREATE TABLE IF NOT EXISTS sync_values ('
+                       'key TEXT PRIMARY KEY, value TEXT)')
+            db.commit()
+            self.db = db
+        return self.db
+
+    def get(self, href):
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT {} FROM sync_state WHERE href = ?'.format(
+                    ', '.join(self.fields)), (href,)).fetchone()
+        return dict(zip(self.fields, row)) if row else None
+
+    # every record by href
+    def records(self):
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT href, {} FROM sync_state'.format(
+                    ', '.join(self.fields))).fetchall()
+        return dict((row[0], dict(zip(self.fields, row[1:]))) for row in rows)
+
+    def put(self, href, **fields):
+        with self.lock:
+            db = self.connect()
+            row = db.execute(
+                'SELECT {} FROM sync_state WHERE href = ?'.format(
+                    ', '.join(self.fields)), (href,)).fetchone()
+            record = dict(zip(self.fields, row or [None] * len(self.fields)))
+            record.update(fields, updated_at=int(time.time()))
+            db.execute(
+                'INSERT OR REPLACE INTO sync_state (href, {}) '
+                'VALUES (?{})'.format(', '.join(self.fields),
+                                      ', ?' * len(self.fields)),
+                [href] + [record[f] for f in self.fields])
+            db.commit()
+
+    def forget(self, href):
+        with self.lock:
+            db = self.connect()
+            db.execute('DELETE FROM sync_state WHERE href = ?', (href,))
+            db.commit()
+
+    # drop every record published to a deleted Zendesk item
+    def forget_item(self, obj_type, id):
+        column = {'categories': 'category_id', 'sections': 'section_id',
+                  'articles': 'article_id'}[obj_type]
+        with self.lock:
+            db = self.connect()
+            db.execute('DELETE FROM sync_state WHERE {} = ?'.format(column),
+                       (id,))
+            db.commit()
+
+    # replace the conref sources a topic was last converted from
+    def set_dependencies(self, topic, sources):
+        with self.lock:
+            db = self.connect()
+            db.execute('DELETE FROM conref_deps WHERE topic = ?', (topic,))
+            db.executemany('INSERT INTO conref_deps (source, topic) '
+                           'VALUES (?, ?)',
+                           [(source, topic) for source in set(sources)
+                            if source != topic])
+            db.commit()
+
+    # topics that pull in a file through conrefs, directly or nested
+    def dependents(self, source):
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT topic FROM conref_deps WHERE source = ?',
+                (source,)).fetchall()
+        return set(row[0] for row in rows)
+
+    def get_value(self, key):
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT value FROM sync_values WHERE key = ?',
+                (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_value(self, key, value):
+        with self.lock:
+            db = self.connect()
+            db.execute('INSERT OR REPLACE INTO sync_values (key, value) '
+                       'VALUES (?, ?)', (key, json.dumps(value)))
+            db.commit()
+
+
+state_backends = {'sqlite': SqliteStateStore}
+
+# token bucket shared by every thread sending Zendesk requests
+# it refills at the plan's per-minute limit, holds back once Zendesk
+# reports few remaining requests and stops everyone for Retry-After
+
+
+class RateLimiter:
+    def __init__(self, per_minute, reserve=0.1):
+        self.reserve = reserve  # share of the limit kept unused
+        self.share = 1.0  # share of the limit this process may use
+        self.set_limit(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def set_limit(self, per_minute):
+        self.limit = per_minute
+        self.rate = per_minute * self.share / 60.0
+        self.capacity = max(1.0, per_minute * self.share / 10.0)
+
+    # parallel workers each take a share of the account's limit
+    def set_share(self, share):
+        with self.lock:
+            self.share = share
+            self.set_limit(self.limit)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update(self, response):
+        headers = response.headers
+        with self.lock:
+            self.refill(time.monotonic())
+            limit = headers.get('X-Rate-Limit')
+            if limit and limit.isdigit() and int(limit) != self.limit:
+                self.set_limit(int(limit))
+            remaining = headers.get('X-Rate-Limit-Remaining')
+            if remaining and remaining.isdigit():
+                spare = int(remaining) - self.limit * self.reserve
+                self.tokens = min(self.tokens, max(spare, 0))
+            if response.status_code == 429:
+                try:
+                    retry_after = float(headers.get('Retry-After', 60))
+                except(ValueError):
+                    retry_after = 60
+                self.tokens = 0
+                self.blocked_until = max(self.blocked_until,
+                                         time.monotonic() + retry_after)
+
 # DELETE function for Zendesk
 
 
 def delete_zendesk_item(obj_type, id):
-    url = zendesk_url + '/api/v2/help_center/{}/{}.json'.format(obj_type, id)
-    auth = (zendesk_username, zendesk_password)
-    r = requests.delete(url=url, auth=auth)
+    url = '/api/v2/help_center/{}/{}.json'.format(obj_type, id)
+    success, r = zendesk_api_call('DELETE', url)
+    if success:
+        forget_zendesk_item(obj_type, id)
+        sync_state.forget_item(obj_type, id)
+        count_summary(obj_type + '_deleted')
+        log(delete_zendesk_item.__name__, obj_type, id)
+    else:
+        report_error(delete_zendesk_item.__name__, obj_type, id, r)
+
+# delete Zendesk items with bounded parallelism
+# nothing is deleted when the run would exceed the zendesk_max_deletes cap
+
+
+def delete_zendesk_items(items):
+    if len(items) > zendesk_max_deletes:
+        count_summary('deletes_blocked', len(items))
+        report_error(delete_zendesk_items.__name__,
+                     'refusing to delete {} items, the limit is {}'.format(
+                         len(items), zendesk_max_deletes))
+        return
+    futures = [zendesk_executor.submit(delete_zendesk_item, obj_type, id)
+               for obj_type, id in items]
+    for f in futures:
+        f.result()
+
+# compare the Zendesk help center against the ditamap in a single pass
+# returns the (obj_type, id) pairs to delete, items inside a deleted
+# category or section are left out as Zendesk deletes them with it
+
+
+def reconcile_zendesk(ditamap):
+    index = get_ditamap_index(ditamap)
+    deletes = []
+
+    categories = {}
+    for c in list_zendesk_categories():
+        category_key = title_to_key(c['name'])
+        categories[c['id']] = category_key
+        if category_key not in index.categories:
+            deletes.append(('categories', c['id']))
+    deleted = set(deletes)
+
+    sections = {}
+    for s in list_zendesk_sections():
+        category_key = categories.get(s['category_id'])
+        if not category_key or ('categories', s['category_id']) in deleted:
+            continue
+        section_key = (category_key, title_to_key(s['name']))
+        sections[s['id']] = section_key
+        if section_key not in index.sections:
+            deletes.append(('sections', s['id']))
+    deleted.update(deletes)
+
+    for a in list_zendesk_articles():
+        section_key = sections.get(a['section_id'])
+        if not section_key or ('sections', a['section_id']) in deleted:
+            continue
+        if section_key + (title_to_key(a['title']),) not in index.articles:
+            deletes.append(('articles', a['id']))
+
+    log(reconcile_zendesk.__name__, len(deletes))
+    return deletes
+
+# hash lookups over a resolved ditamap, built once per map
+# names and titles are matched through title_to_key
+
+
+class DitamapIndex:
+    def __init__(self, ditamap):
+        self.ditamap = ditamap
+        self.hrefs = {}  # href -> (category, section, article title)
+        self.categories = set()
+        self.sections = set()
+        self.articles = set()
+        for category in ditamap.get('children', []):
+            category_key = title_to_key(category['title'])
+            self.categories.add(category_key)
+            for section in category.get('children', []):
+                if 'children' in section:
+                    self.sections.add(
+                        (category_key, title_to_key(section['title'])))
+
+        # articles directly under a category sit in a section of its name
+        for category_name, section_name, article_title, article_href \
+                in ditamap_articles(ditamap):
+            keys = (title_to_key(category_name), title_to_key(section_name))
+            self.sections.add(keys)
+            if article_title:
+                self.articles.add(keys + (title_to_key(article_title),))
+            self.hrefs[article_href] = (
+                category_name, section_name, article_title)
+
+# returns the index of a ditamap, rebuilt only when the map changes
+
+
+def get_ditamap_index(ditamap):
+    index = ditamap_indexes.get('current')
+    if index is None or index.ditamap is not ditamap:
+        index = ditamap_indexes['current'] = DitamapIndex(ditamap)
+    return index
 
 # find category in ditamap
 
 
 def is_category_mapped(ditamap, category_name):
-    for category in ditamap['children']:
-        if category['title'] == category_name:
-            return True
+    index = get_ditamap_index(ditamap)
+    return title_to_key(category_name) in index.categories
 
 # find section in ditamap
 
 
 def is_section_mapped(ditamap, category_name, section_name):
-    for category in ditamap['children']:
-        if category['title'] == category_name:
-            for section in category['children']:
-                if section['title'] == section_name:
-                    return True
+    index = get_ditamap_index(ditamap)
+    return (title_to_key(category_name),
+            title_to_key(section_name)) in index.sections
 
 # find article in ditamap
 
 
 def is_article_mapped(ditamap, category_name, section_name, article_title):
-    for category in ditamap['children']:
-        if category['title'] == category_name:
-            for section in category['children']:
-                if section['title'] == section_name:
-                    if 'children' in section:
-                        for article in section['children']:
-                            if article['title'] == article_title:
-                                return True
+    index = get_ditamap_index(ditamap)
+    return (title_to_key(category_name), title_to_key(section_name),
+            title_to_key(article_title)) in index.articles
 
-# return a ditamap representation by recursively retrieving all ditamap files
+# return a ditamap representation by retrieving all ditamap files
+# sub-maps are fetched concurrently one level at a time, each file once
+# topics are not fetched, their title is the topicref navtitle or None
+# until resolve_ditamap_titles or the article conversion fills it in
 
 
 def git_dita_map(path='fh_success_site.ditamap'):
-    # return {"children":[]}
-    ditamap_url = github_url + '/contents/DITA/' + path
-    page_contents = github_get(ditamap_url)
-    content = decode_content(page_contents['content'])
+    maps = {}
+    level = [path]
+    while level:
+        futures = [github_executor.submit(parse_ditamap, p) for p in level]
+        next_level = []
+        for p, f in zip(level, futures):
+            maps[p] = f.result()
+            for topicref in maps[p]['topicrefs'] or []:
+                href = topicref['href']
+                if '.ditamap' in href and href not in maps and \
+                        href not in next_level:
+                    next_level.append(href)
+        level = next_level
+    return assemble_ditamap(path, maps, ())
+
+# read the title and direct topicrefs of a ditamap file
+
+
+def parse_ditamap(path):
+    content = get_dita_file(path)
     soup = BeautifulSoup(content, features=xml_parser)
     map = soup.find('map')
     title = soup.find('title').text
-    if map:
-        topicrefs = map.findChildren('topicref', recursive=False)
-        lst = []
-        for topicref in topicrefs:
-            if '.ditamap' in topicref['href']:
-                lst.append(git_dita_map(topicref['href']))
-            else:
-                lst.append(git_dita_map(topicref['href']))
-        return {'children': lst, 'title': title, 'href': path}
-    return {'title': title, 'href': path}
+    if not map:
+        return {'title': title, 'topicrefs': None}
+    topicrefs = []
+    for topicref in map.findChildren('topicref', recursive=False):
+        navtitle = topicref.get('navtitle')
+        if not navtitle:
+            tag = topicref.find('topicmeta', recursive=False)
+            tag = tag and tag.find('navtitle', recursive=False)
+            navtitle = tag and tag.text.strip()
+        topicrefs.append({'href': topicref['href'],
+                          'title': navtitle or None})
+    return {'title': title, 'topicrefs': topicrefs}
+
+# build the nested ditamap from parsed files, skipping circular references
+
+
+def assemble_ditamap(path, maps, ancestors):
+    parsed = maps[path]
+    if parsed['topicrefs'] is None:
+        return {'title': parsed['title'], 'href': path}
+    ancestors = ancestors + (path,)
+    lst = []
+    for topicref in parsed['topicrefs']:
+        href = topicref['href']
+        if '.ditamap' not in href:
+            lst.append(dict(topicref))
+        elif href in ancestors:
+            report_error(assemble_ditamap.__name__, 'ditamap cycle',
+                         ' > '.join(ancestors + (href,)))
+        else:
+            lst.append(assemble_ditamap(href, maps, ancestors))
+    return {'children': lst, 'title': parsed['title'], 'href': path}
 
-# check if a file is in the ditamap
-# due to the nature of the git_dita_map method, only .dita files need to
-# be checked
+# fill in the ditamap titles that were deferred, fetching the topics that
+# were not converted during this run concurrently
+
+
+def resolve_ditamap_titles(ditamap):
+    leaves = []
+    stack = [ditamap]
+    while stack:
+        node = stack.pop()
+        if 'children' in node:
+            stack.extend(node['children'])
+        elif not node['title']:
+            leaves.append(node)
+    if not leaves:
+        return ditamap
+    futures = [github_executor.submit(get_dita_file_title, leaf['href'])
+               for leaf in leaves]
+    for leaf, f in zip(leaves, futures):
+        leaf['title'] = f.result()
+    ditamap_indexes.clear()  # titles changed, rebuild the index
+    return ditamap
+
+# returns the title of a topic, reusing the one found at conversion
+
+
+def get_dita_file_title(path):
+    path = dita_path(path)
+    if path not in dita_titles:
+        dita_titles[path] = get_article_title(get_dita_file(path))
+    return dita_titles[path]
+
+# check if a file is in the ditamap, returns (category, section, title)
+# the title is None when the ditamap does not provide one
+# hrefs may be paths relative to DITA/ or github contents urls
 
 
 def get_file_mapping(href, ditamap):
     if href and ditamap:
-        for c in ditamap['children']:
-            for s in c['children']:
-                if 'children' in s:
-                    for a in s['children']:
-                        if a['href'] == href:
-                            return (c['title'], s['title'])
-                if s['href'] == href:
-                    return (c['title'], '')
+        return get_ditamap_index(ditamap).hrefs.get(dita_path(href))
 
-# retrieve the contents of an html/xml tag
+# path relative to DITA/ of a github contents url or DITA path
 
 
-def get_tag_content(raw_xml, tag_id):
-    soup = BeautifulSoup(raw_xml, features='xml')
-    tags = soup.findAll(attrs={"id": tag_id})
-    return tags[0]
+def dita_path(href):
+    href = href.split('?')[0]
+    if '/contents/DITA/' in href:
+        href = href.split('/contents/DITA/', 1)[1]
+    return href.lstrip('/')
 
-# replace xml conref content
+# index every element with an id in a conref source file, parsed once per
+# run, the first element with a given id wins
 
 
-def update_conrefs(raw_xml):
+def conref_index(path):
+    soup = parse_dita(get_dita_file(path))
+    index = {}
+    for tag in soup.find_all(attrs={'id': True}):
+        index.setdefault(tag['id'], tag)
+    return index
 
-    soup = BeautifulSoup(raw_xml, features='xml')
 
-    # find each conref
-    for tag in soup.select('[conref]'):
+conref_index = Memoize(conref_index)
 
-        conref = tag['conref']  # conref attribute value
+# split a conref into the source file path and the target element id
+# paths are relative to the referencing file, '../' points to DITA/ and
+# an empty path refers to the referencing file itself
 
-        try:
-            path = conref.split("#")[0].replace(
-                '../', '/')   # path to conref file
-            tag_id = conref.split('/')[-1]  # conref tag id
 
-        except(IndexError):
-            # tag id or path is not available
-            # todo: conref syntax incorrect - does this warrant logging an
-            # error?
-            continue
+def conref_target(conref, base_path=''):
+    path = conref.split('#')[0]
+    tag_id = conref.split('/')[-1]  # conref tag id
+    if not path:
+        path = base_path
+    elif '../' in path:
+        path = path.replace('../', '/')
+    else:
+        path = posixpath.join(posixpath.dirname(base_path), path)
+    return path.lstrip('/'), tag_id
 
-        # retrieve the file
-        raw_json = github_get(github_url + '/contents/DITA' + path)
+# raised when conrefs end up referencing themselves
+
+
+class ConrefCycle(Exception):
+    pass
+
+# returns a conref target with its own conrefs resolved and the set of
+# files it was built from, fragments are memoized for the run
+# raises KeyError if the file or element does not exist
 
-        try:
-            file_content = decode_content(raw_json['content'])
 
+def resolve_conref(path, tag_id, stack=()):
+    key = (path, tag_id)
+    if key in resolved_conrefs:
+        return resolved_conrefs[key]
+    if key in stack:
+        raise ConrefCycle(' > '.join('#'.join(k) for k in stack + (key,)))
+
+    fragment = copy.copy(conref_index(path)[tag_id])
+    sources = {path}
+    nested = fragment.select('[conref]')
+    if fragment.has_attr('conref'):
+        nested.insert(0, fragment)
+    for tag in nested:
+        nested_path, nested_id = conref_target(tag['conref'], path)
+        try:
+            content, nested_sources = resolve_conref(
+                nested_path, nested_id, stack + (key,))
         except(KeyError):
-            # file not retrieved
-            # todo: file not retrieved - does this warrant logging an error?
-            return raw_xml
+            # todo: conref not found - does this warrant logging an error?
+            sources.add(nested_path)
+            continue
+        sources.update(nested_sources)
+        if tag is fragment:
+            fragment = copy.copy(content)
+        else:
+            tag.replace_with(copy.copy(content))
 
+    resolved_conrefs[key] = (fragment, sources)
+    return resolved_conrefs[key]
+
+# replace xml conref content
+# a parsed tree is updated in place and returned, text is returned as text
+# conref_paths collects every file the replaced content came from
+
+
+def update_conrefs(raw_xml, conref_paths=None, base_path=''):
+
+    dependencies = []
+    soup = parse_dita(raw_xml)
+    targets = [(tag, conref_target(tag['conref'], base_path))
+               for tag in soup.select('[conref]')]
+
+    # start fetching every referenced file
+    prefetch_dita_files(set(path for tag, (path, tag_id) in targets
+                            if path and path not in dita_files))
+
+    # find each conref
+    for tag, (path, tag_id) in targets:
+        dependencies.append(path)  # record the dependency
         try:
             # find the appropriate conref in the file
-            tag_content = get_tag_content(file_content, tag_id)
+            tag_content, sources = resolve_conref(path, tag_id)
 
-            # update the original conref with the found content
-            tag.replace_with(tag_content)
+        except(KeyError, IndexError):
+            # todo: file or conref not found - does this warrant logging an
+            # error?
+            continue
 
-        except(IndexError):
-            # todo: conref not found - does this warrant logging an error?
+        except(ConrefCycle) as e:
+            report_error(update_conrefs.__name__, 'conref cycle', str(e))
             continue
 
-    return str(soup)
+        dependencies.extend(sources)
+
+        # update the original conref with a copy of the found content
+        tag.replace_with(copy.copy(tag_content))
+
+    # remember which files this topic depends on for later pushes
+    if conref_paths is not None:
+        conref_paths.extend(dependencies)
+    if base_path:
+        sync_state.set_dependencies(base_path, dependencies)
 
-# convert dita xml to html
+    return soup if soup is raw_xml else str(soup)
+
+# convert dita xml to html with the configured converter engine
 
 
 def convert_xml(raw_xml):
+    if xml_converter == 'xslt':
+        return convert_xml_xslt(raw_xml)
+    return convert_xml_soup(raw_xml)
+
+# convert dita xml to html with beautifulsoup
+
+
+def convert_xml_soup(raw_xml):
+
+    if isinstance(raw_xml, BeautifulSoup):
+        soup = raw_xml
+        for node in list(soup.contents):
+            if isinstance(node, Doctype) and node == topic_doctype:
+                node.extract()
+    else:
+        raw_xml = raw_xml.replace(
+            '<?xml version="1.0" encoding="utf-8"?>', '')
+        raw_xml = raw_xml.replace('<!DOCTYPE ' + topic_doctype + '>', '')
+        soup = BeautifulSoup(raw_xml, features=xml_parser)
+
+    # walk the document once, rules see the original tag and parent names
+    # even after an earlier rule renamed them
+    tags = [(tag, tag.name, tag.parent, tag.parent.name)
+            for tag in soup.find_all(True)]
+    state = {
+        'soup': soup,
+        'tables': 0,
+        'removed': set(),  # ids of tags no longer in the document
+        'first_body': next((t[0] for t in tags if t[1] == 'body'), None),
+        'body_sections': set(),  # ids of sections inside the first body
+    }
+    for tag, name, parent, parent_name in tags:
+        if id(tag) in state['removed'] or id(parent) in state['removed']:
+            state['removed'].add(id(tag))
+            continue
+        for attrs, rule_parent, rule in convert_rules.get(name, ()):
+            if rule_parent and rule_parent != parent_name:
+                continue
+            if all(tag.get(k) == v for k, v in attrs.items()):
+                rule(tag, state)
+                break
+
+    return str(soup)
+
+# convert_xml_soup rules by tag name, see convert_rule
+convert_rules = {}
+
+# register a convert_xml_soup rule for a tag name, optionally limited to a
+# parent tag name and to attribute values, the first matching rule wins
+
+
+def convert_rule(name, parent=None, **attrs):
+    def register(rule):
+        convert_rules.setdefault(name, []).append((attrs, parent, rule))
+        return rule
+    return register
+
+# wrap a tag in a new tag
+
+
+def wrap_tag(to_wrap, wrap_in):
+    contents = to_wrap.replace_with(wrap_in)
+    wrap_in.append(contents)
+
+# topic > body, body > div class body
+
+
+@convert_rule('topic', parent='[document]')
+def convert_root_topic(tag, state):
+    tag.name = 'body'
+
+
+@convert_rule('body', parent='topic')
+def convert_topic_body(tag, state):
+    if tag.parent.parent is state['soup']:
+        tag.name = 'div'
+        tag['class'] = 'body'
+
+# topic title
+
+
+@convert_rule('title', parent='topic')
+def convert_topic_title(tag, state):
+    tag.name = 'h1'
+    tag['class'] = "title topictitle1"
+
+# p, li, ol, ul
+
+
+@convert_rule('p')
+@convert_rule('li')
+@convert_rule('ol')
+@convert_rule('ul')
+def convert_list_or_paragraph(tag, state):
+    tag['class'] = tag.name
 
-    def wrap(to_wrap, wrap_in):
-        contents = to_wrap.replace_with(wrap_in)
-        wrap_in.append(contents)
-
-    raw_xml = raw_xml.replace('<?xml version="1.0" encoding="utf-8"?>', '')
-    raw_xml = raw_xml.replace(
-        '<!DOCTYPE topic PUBLIC "-//OASIS//DTD DITA Topic//EN" "topic.dtd">', '')
-
-    soup = BeautifulSoup(raw_xml, features=xml_parser)
-
-    # topic title
-    topics = soup.find_all('topic')
-    for topic in topics:
-        titles = topic.findChildren('title', recursive=False)
-        for ttl in titles:
-            ttl.name = 'h1'
-            ttl['class'] = "title topictitle1"
-
-    # p, li, ol, ul
-    for tag in ['p', 'li', 'ol', 'ul']:
-        all = soup.find_all(tag)
-        for i in all:
-            i['class'] = tag
-
-    # xref
-    all = soup.find_all('xref')
-    for i in all:
-        i.name = 'a'
-        i['class'] = 'xx'
-
-    # note
-    all = soup.find_all('note', attrs={'type': 'note'})
-    for i in all:
-        i.name = 'div'
-        i['class'] = 'note note'
-        new_tag = soup.new_tag('span', **{'class': 'notetitle'})
-        new_tag.string = 'NOTE:'
-        i.insert(1, new_tag)
-
-    # tip
-    all = soup.find_all('note', attrs={'type': 'tip'})
-    for i in all:
-        i.name = 'div'
-        i['class'] = 'note tip'
-        tip_tag = soup.new_tag('span', **{'class': 'tiptitle'})
-        tip_tag.string = 'TIP:'
-        i.insert(0, tip_tag)
-
-    # <tm tmtype="tm">
-    all = soup.find_all('tm', attrs={'tmtype': 'tm'})
-    for i in all:
-        s = i.text
-        i.replaceWith(s + '™')
-
-    # <tm tmtype="reg">
-    all = soup.find_all('tm', attrs={'tmtype': 'reg'})
-    for i in all:
-        s = i.text
-        i.replaceWith(s + '®')
-
-    # warning
-    all = soup.find_all('note', attrs={'type': 'warning'})
-    for i in all:
-        i.name = 'div'
-        i['class'] = 'note warning note_warning'
-        warning_tag = soup.new_tag('span', **{'class': 'note__title'})
-        warning_tag.string = 'WARNING:'
-        i.insert(0, warning_tag)
-
-    # codeblock
-    codeblocks = soup.find_all('codeblock')
-    for codeblock in codeblocks:
-        codeblock.name = 'code'
-        pre_tag = soup.new_tag('pre')
-        pre_tag['class'] = 'pre codeblock'
-        wrap(codeblock, pre_tag)
-
-    # codeph
-    all = soup.find_all('codeph')
-    for i in all:
-        i.name = 'code'
-
-    # userinput
-    all = soup.find_all('userinput')
-    for i in all:
-        i.name = 'kbd'
-        i['class'] = 'ph userinput'
-
-    # b
-    all = soup.find_all('b')
-    for i in all:
-        i.name = 'strong'
-        i['class'] = 'ph b'
-
-    # i
-    all = soup.find_all('i')
-    for i in all:
-        i.name = 'em'
-        i['class'] = 'ph i'
-
-    # fig
-    all = soup.find_all('fig')
-    for i in all:
-        i.name = 'figure'
-        i['class'] = 'fig fignone'
-
-        # fig title
-        titles = i.findChildren('title', recursive=False)
-        for t in titles:
-            t.name = 'p'
-            t['class'] = 'figcap'
-
-        # fig span
-        new_tag = soup.new_tag('span')
+# xref
+
+
+@convert_rule('xref')
+def convert_xref(tag, state):
+    tag.name = 'a'
+    tag['class'] = 'xx'
+
+# note
+
+
+@convert_rule('note', type='note')
+def convert_note(tag, state):
+    tag.name = 'div'
+    tag['class'] = 'note note'
+    new_tag = state['soup'].new_tag('span', **{'class': 'notetitle'})
+    new_tag.string = 'NOTE:'
+    tag.insert(1, new_tag)
+
+# tip
+
+
+@convert_rule('note', type='tip')
+def convert_tip(tag, state):
+    tag.name = 'div'
+    tag['class'] = 'note tip'
+    tip_tag = state['soup'].new_tag('span', **{'class': 'tiptitle'})
+    tip_tag.string = 'TIP:'
+    tag.insert(0, tip_tag)
+
+# warning
+
+
+@convert_rule('note', type='warning')
+def convert_warning(tag, state):
+    tag.name = 'div'
+    tag['class'] = 'note warning note_warning'
+    warning_tag = state['soup'].new_tag('span', **{'class': 'note__title'})
+    warning_tag.string = 'WARNING:'
+    tag.insert(0, warning_tag)
+
+# <tm tmtype="tm">, <tm tmtype="reg">
+
+
+@convert_rule('tm', tmtype='tm')
+def convert_trademark(tag, state):
+    tag.replace_with(tag.text + '™')
+    state['removed'].add(id(tag))
+
+
+@convert_rule('tm', tmtype='reg')
+def convert_registered_trademark(tag, state):
+    tag.replace_with(tag.text + '®')
+    state['removed'].add(id(tag))
+
+# codeblock
+
+
+@convert_rule('codeblock')
+def convert_codeblock(tag, state):
+    tag.name = 'code'
+    pre_tag = state['soup'].new_tag('pre')
+    pre_tag['class'] = 'pre codeblock'
+    wrap_tag(tag, pre_tag)
+
+# codeph
+
+
+@convert_rule('codeph')
+def convert_codeph(tag, state):
+    tag.name = 'code'
+
+# userinput
+
+
+@convert_rule('userinput')
+def convert_userinput(tag, state):
+    tag.name = 'kbd'
+    tag['class'] = 'ph userinput'
+
+# b
+
+
+@convert_rule('b')
+def convert_bold(tag, state):
+    tag.name = 'strong'
+    tag['class'] = 'ph b'
+
+# i
+
+
+@convert_rule('i')
+def convert_italic(tag, state):
+    tag.name = 'em'
+    tag['class'] = 'ph i'
+
+# fig, the prefix goes in the fig title or first in the figure
+
+
+@convert_rule('fig')
+def convert_fig(tag, state):
+    tag.name = 'figure'
+    tag['class'] = 'fig fignone'
+    if not tag.find('title', recursive=False):
+        new_tag = state['soup'].new_tag('span')
         new_tag['class'] = 'figtitleprefix'
         new_tag.string = "Figure: "
-        if t:
-            t.insert(0, new_tag)
-        else:
-            i.insert(0, new_tag)
-
-    # image
-    all = soup.find_all('image')
-    for i in all:
-        i.name = 'img'
-        i['src'] = i['href']
-        i['class'] = 'image'
-        i.attrs = {'src': i['href'], 'class': 'image'}
-
-    # tables
-    count = 0
-    all = soup.find_all('table')
-    for tbl in all:
-        count += 1
-        tbl['class'] = 'tablenoborder'
-
-        # caption
-        cap = soup.new_tag('caption')
-
-        # get the table's title
-        title = ''
-        titles = tbl.findChildren('title', recursive=False)
-        for t in titles:
-            title = t.string
-            t.decompose()
-
-        # add the first span
-        span = soup.new_tag('span')
-        span['class'] = 'tablecap'
-        if title:
-            span.string = title
-        cap.insert(0, span)
-
-        # table title span
-        span2 = soup.new_tag('span')
-        span2['class'] = 'table--title-label'
-        span2.string = 'Table ' + str(count) + '.'
-        span.insert(0, span2)
-        tbl.insert(0, cap)
-
-        # row > tr class="row"
-        rows = tbl.findChildren('row')
-        for row in rows:
-            row.name = 'tr'
-            row['class'] = 'row'
-
-        # entry > th class="entry cellrowborder" style="text-align:left;"
-        entries = tbl.findChildren('entry')
-        for entry in entries:
-            entry.name = 'th'
-            entry['class'] = 'entry cellrowborder'
-            entry['style'] = 'text-align:left;'
-
-        # insert the whole table inside a div class="tablenoborder"
-        new_tbl_div = soup.new_tag("div")
-        new_tbl_div['class'] = 'tablenoborder'
-        wrap(tbl, new_tbl_div)
-
-    # section titles
-    body = soup.find('body')
-    for section in body.findChildren('section'):
-        # title
-        titles = section.findChildren('title', recursive=False)
-        for ttl in titles:
-            ttl.name = 'h2'
-            ttl['class'] = 'title sectiontitle'
-
-        # section > div
-        section.name = 'div'
-        section['class'] = 'section'
-
-    # topic > body
-    topics = soup.find_all('topic', recursive=False)
-    for topic in topics:
-        topic.name = 'body'
-        # body > div class body
-        for body in topic.findChildren('body', recursive=False):
-            body.name = 'div'
-            body['class'] = 'body'
+        tag.insert(0, new_tag)
+
+
+@convert_rule('title', parent='fig')
+def convert_fig_title(tag, state):
+    tag.name = 'p'
+    tag['class'] = 'figcap'
+    new_tag = state['soup'].new_tag('span')
+    new_tag['class'] = 'figtitleprefix'
+    new_tag.string = "Figure: "
+    tag.insert(0, new_tag)
+
+# image
+
+
+@convert_rule('image')
+def convert_image(tag, state):
+    tag.name = 'img'
+    tag.attrs = {'src': tag['href'], 'class': 'image'}
+
+# tables
 
-    return str(soup)
+
+@convert_rule('table')
+def convert_table(tag, state):
+    soup = state['soup']
+    state['tables'] += 1
+    tag['class'] = 'tablenoborder'
+
+    # caption
+    cap = soup.new_tag('caption')
+
+    # get the table's title
+    title = ''
+    for t in tag.find_all('title', recursive=False):
+        title = t.string
+        t.extract()
+        state['removed'].add(id(t))
+
+    # add the first span
+    span = soup.new_tag('span')
+    span['class'] = 'tablecap'
+    if title:
+        span.string = title
+    cap.insert(0, span)
+
+    # table title span
+    span2 = soup.new_tag('span')
+    span2['class'] = 'table--title-label'
+    span2.string = 'Table ' + str(state['tables']) + '.'
+    span.insert(0, span2)
+    tag.insert(0, cap)
+
+    # insert the whole table inside a div class="tablenoborder"
+    new_tbl_div = soup.new_tag("div")
+    new_tbl_div['class'] = 'tablenoborder'
+    wrap_tag(tag, new_tbl_div)
+
+# row > tr class="row"
+
+
+@convert_rule('row')
+def convert_table_row(tag, state):
+    if tag.find_parent('table'):
+        tag.name = 'tr'
+        tag['class'] = 'row'
+
+# entry > th class="entry cellrowborder" style="text-align:left;"
+
+
+@convert_rule('entry')
+def convert_table_entry(tag, state):
+    if tag.find_parent('table'):
+        tag.name = 'th'
+        tag['class'] = 'entry cellrowborder'
+        tag['style'] = 'text-align:left;'
+
+# section > div, for the sections of the first body
+
+
+@convert_rule('section')
+def convert_section(tag, state):
+    if any(p is state['first_body'] for p in tag.parents):
+        state['body_sections'].add(id(tag))
+        tag.name = 'div'
+        tag['class'] = 'section'
+
+
+@convert_rule('title', parent='section')
+def convert_section_title(tag, state):
+    if id(tag.parent) in state['body_sections']:
+        tag.name = 'h2'
+        tag['class'] = 'title sectiontitle'
+
+# xslt 1.0 version of the convert_xml_soup rules, run by lxml
+dita_to_html_xslt = '''<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:output method="xml" omit-xml-declaration="yes"/>
+
+  <!-- anything without a rule is copied as it is -->
+  <xsl:template match="@*|node()">
+    <xsl:copy><xsl:apply-templates select="@*|node()"/></xsl:copy>
+  </xsl:template>
+
+  <xsl:template name="attributes">
+    <xsl:param name="class"/>
+    <xsl:attribute name="class"><xsl:value-of select="$class"/></xsl:attribute>
+    <xsl:apply-templates select="@*[name() != 'class']"/>
+  </xsl:template>
+
+  <xsl:template name="renamed">
+    <xsl:param name="name"/>
+    <xsl:param name="class"/>
+    <xsl:element name="{$name}">
+      <xsl:call-template name="attributes">
+        <xsl:with-param name="class" select="$class"/>
+      </xsl:call-template>
+      <xsl:apply-templates/>
+    </xsl:element>
+  </xsl:template>
+
+  <!-- topic > body, body > div class body -->
+  <xsl:template match="/topic">
+    <body><xsl:apply-templates select="@*|node()"/></body>
+  </xsl:template>
+
+  <xsl:template match="/topic/body">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">div</xsl:with-param>
+      <xsl:with-param name="class">body</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+
+  <!-- topic title -->
+  <xsl:template match="topic/title">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">h1</xsl:with-param>
+      <xsl:with-param name="class">title topictitle1</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+
+  <!-- p, li, ol, ul -->
+  <xsl:template match="p|li|ol|ul">
+    <xsl:copy>
+      <xsl:call-template name="attributes">
+        <xsl:with-param name="class" select="local-name()"/>
+      </xsl:call-template>
+      <xsl:apply-templates/>
+    </xsl:copy>
+  </xsl:template>
+
+  <!-- xref -->
+  <xsl:template match="xref">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">a</xsl:with-param>
+      <xsl:with-param name="class">xx</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+
+  <!-- note, the label goes after the first child node -->
+  <xsl:template match="note[@type='note']">
+    <div>
+      <xsl:call-template name="attributes">
+        <xsl:with-param name="class">note note</xsl:with-param>
+      </xsl:call-template>
+      <xsl:apply-templates select="node()[1]"/>
+      <span class="notetitle">NOTE:</span>
+      <xsl:apply-templates select="node()[position() > 1]"/>
+    </div>
+  </xsl:template>
+
+  <!-- tip -->
+  <xsl:template match="note[@type='tip']">
+    <div>
+      <xsl:call-template name="attributes">
+        <xsl:with-param name="class">note tip</xsl:with-param>
+      </xsl:call-template>
+      <span class="tiptitle">TIP:</span>
+      <xsl:apply-templates/>
+    </div>
+  </xsl:template>
+
+  <!-- warning -->
+  <xsl:template match="note[@type='warning']">
+    <div>
+      <xsl:call-template name="attributes">
+        <xsl:with-param name="class">note warning note_warning</xsl:with-param>
+      </xsl:call-template>
+      <span class="note__title">WARNING:</span>
+      <xsl:apply-templates/>
+    </div>
+  </xsl:template>
+
+  <!-- <tm tmtype="tm">, <tm tmtype="reg"> -->
+  <xsl:template match="tm[@tmtype='tm']">
+    <xsl:value-of select="concat(., '™')"/>
+  </xsl:template>
+
+  <xsl:template match="tm[@tmtype='reg']">
+    <xsl:value-of select="concat(., '®')"/>
+  </xsl:template>
+
+  <!-- codeblock -->
+  <xsl:template match="codeblock">
+    <pre class="pre codeblock">
+      <code><xsl:apply-templates select="@*|node()"/></code>
+    </pre>
+  </xsl:template>
+
+  <!-- codeph -->
+  <xsl:template match="codeph">
+    <code><xsl:apply-templates select="@*|node()"/></code>
+  </xsl:template>
+
+  <!-- userinput -->
+  <xsl:template match="userinput">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">kbd</xsl:with-param>
+      <xsl:with-param name="class">ph userinput</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+
+  <!-- b, i -->
+  <xsl:template match="b">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">strong</xsl:with-param>
+      <xsl:with-param name="class">ph b</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+
+  <xsl:template match="i">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">em</xsl:with-param>
+      <xsl:with-param name="class">ph i</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+
+  <!-- fig, the prefix goes in the title or first in the figure -->
+  <xsl:template match="fig">
+    <figure>
+      <xsl:call-template name="attributes">
+        <xsl:with-param name="class">fig fignone</xsl:with-param>
+      </xsl:call-template>
+      <xsl:if test="not(title)">
+        <span class="figtitleprefix">Figure: </span>
+      </xsl:if>
+      <xsl:apply-templates/>
+    </figure>
+  </xsl:template>
+
+  <xsl:template match="fig/title">
+    <p>
+      <xsl:call-template name="attributes">
+        <xsl:with-param name="class">figcap</xsl:with-param>
+      </xsl:call-template>
+      <span class="figtitleprefix">Figure: </span>
+      <xsl:apply-templates/>
+    </p>
+  </xsl:template>
+
+  <!-- image -->
+  <xsl:template match="image">
+    <img class="image" src="{@href}"/>
+  </xsl:template>
+
+  <!-- tables, numbered in document order and wrapped in a div -->
+  <xsl:template match="table">
+    <div class="tablenoborder">
+      <table>
+        <xsl:call-template name="attributes">
+          <xsl:with-param name="class">tablenoborder</xsl:with-param>
+        </xsl:call-template>
+        <caption>
+          <span class="tablecap">
+            <span class="table--title-label">
+              <xsl:text>Table </xsl:text>
+              <xsl:number level="any" count="table"/>
+              <xsl:text>.</xsl:text>
+            </span>
+            <!-- only titles made of a single text are kept -->
+            <xsl:variable name="title" select="title[last()]"/>
+            <xsl:if test="$title and not($title/descendant-or-self::*[
+                count(node()) != 1])">
+              <xsl:value-of select="$title"/>
+            </xsl:if>
+          </span>
+        </caption>
+        <xsl:apply-templates select="node()[not(self::title)]"/>
+      </table>
+    </div>
+  </xsl:template>
+
+  <!-- row > tr class="row" -->
+  <xsl:template match="table//row">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">tr</xsl:with-param>
+      <xsl:with-param name="class">row</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+
+  <!-- entry > th class="entry cellrowborder" style="text-align:left;" -->
+  <xsl:template match="table//entry">
+    <th>
+      <xsl:attribute name="class">entry cellrowborder</xsl:attribute>
+      <xsl:apply-templates select="@*[name() != 'class' and
+                                      name() != 'style']"/>
+      <xsl:attribute name="style">text-align:left;</xsl:attribute>
+      <xsl:apply-templates/>
+    </th>
+  </xsl:template>
+
+  <!-- sections of the first body, section > div -->
+  <xsl:template match="section[ancestor::body[not(ancestor::body) and
+                                              not(preceding::body)]]">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">div</xsl:with-param>
+      <xsl:with-param name="class">section</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+
+  <xsl:template match="section[ancestor::body[not(ancestor::body) and
+                                              not(preceding::body)]]/title">
+    <xsl:call-template name="renamed">
+      <xsl:with-param name="name">h2</xsl:with-param>
+      <xsl:with-param name="class">title sectiontitle</xsl:with-param>
+    </xsl:call-template>
+  </xsl:template>
+</xsl:stylesheet>
+'''
+
+# convert dita xml to html with the compiled xslt stylesheet
+# the stylesheet is compiled once per thread and reused across calls
+
+
+def convert_xml_xslt(raw_xml):
+    transform = getattr(xslt_local, 'transform', None)
+    if transform is None:
+        stylesheet = etree.XML(dita_to_html_xslt.encode('utf-8'))
+        transform = xslt_local.transform = etree.XSLT(stylesheet)
+    parser = etree.XMLParser(
+        load_dtd=False, no_network=True, resolve_entities=False)
+    doc = etree.fromstring(str(raw_xml).encode('utf-8'), parser)
+
+    # collapse whitespace only text like BeautifulSoup does when it parses
+    for element in doc.iter():
+        element.text = collapse_whitespace(element.text)
+        element.tail = collapse_whitespace(element.tail)
+    root = transform(doc).getroot()
+
+    # write attributes in sorted order like BeautifulSoup, which also treats
+    # the namespace declarations of the root as ordinary attributes
+    for element in root.iter(tag=etree.Element):
+        attributes = sorted(element.attrib.items())
+        element.attrib.clear()
+        for name, value in attributes:
+            element.set(name, value)
+    html = etree.tostring(root, encoding='unicode')
+    if root.nsmap:
+        prefixes = dict((uri, prefix) for prefix, uri in root.nsmap.items())
+        attributes = [(etree.QName(name), value)
+                      for name, value in root.attrib.items()]
+        attributes = [(prefixes[name.namespace] + ':' + name.localname
+                       if name.namespace else name.localname, value)
+                      for name, value in attributes]
+        attributes += [('xmlns:' + prefix if prefix else 'xmlns', uri)
+                       for prefix, uri in root.nsmap.items()]
+        start_tag = '<{}{}>'.format(root.tag, ''.join(
+            ' {}="{}"'.format(name, xml_escape(value, {'"': '&quot;'}))
+            for name, value in sorted(attributes)))
+        html = start_tag + html[html.index('>') + 1:]
+    return '<?xml version="1.0" encoding="utf-8"?>\n' + html
+
+# whitespace only text becomes a single newline, or a space when it has no
+# newline, other text is returned as it is
+
+
+def collapse_whitespace(text):
+    if not text or text.strip(' \t\n\r\f'):
+        return text
+    return '\n' if '\n' in text else ' '
+
+# parse DITA xml, trees that are already parsed are returned as they are
+
+
+def parse_dita(raw_xml):
+    if isinstance(raw_xml, BeautifulSoup):
+        return raw_xml
+    return BeautifulSoup(raw_xml, features=xml_parser)
 
 # retrieve the title from the title xml element
 
 
 def get_article_title(raw_xml):
-    soup = BeautifulSoup(raw_xml, features=xml_parser)
+    soup = parse_dita(raw_xml)
     title = soup.find('title')
     if title:
         return title.text
@@ -626,15 +2017,163 @@ def report_error(*args):
 
 
 def github_get(url=github_url, path=''):
-    auth = (gh_username, gh_token)
     if path:
         url = url + path
-    r = requests.get(url=url, auth=auth)
+
+    # conditional requests answered with 304 do not count against the rate
+    # limit, the body is then served from the etag cache
+    cached = github_cache.get(url)
+    headers = {'If-None-Match': cached['etag']} if cached else {}
+    r = http_session(github_url).get(url=url, headers=headers)
+    if r.status_code == 304 and cached:
+        return cached['body']
     j = json.loads(r.text)
+    etag = r.headers.get('ETag')
+    if r.status_code == 200 and etag:
+        github_cache.set(url, {'etag': etag, 'body': j})
     return j
 
 
 github_get = Memoize(github_get)
+github_cache = DiskCache(github_cache_dir, github_cache_max_bytes)
+conversion_cache = TieredCache(conversion_cache_dir,
+                               conversion_cache_max_bytes,
+                               conversion_cache_entries)
+publish_records = DiskCache(publish_record_dir, 8 * 1024 * 1024)
+zendesk_rate_limiter = RateLimiter(zendesk_rate_limit)
+zendesk_catalog_cache = DiskCache(zendesk_catalog_dir, 64 * 1024 * 1024)
+sync_state = state_backends[state_backend](state_store_path)
+
+# bounded pools shared by every concurrent github and Zendesk request
+github_executor = ThreadPoolExecutor(max_workers=github_concurrency)
+zendesk_executor = ThreadPoolExecutor(max_workers=zendesk_concurrency)
+
+# start fetching a batch of github urls, futures are returned in order
+# the results land in the github_get cache, so later calls do not block
+
+
+def github_prefetch(urls):
+    return [github_executor.submit(github_get, url) for url in urls]
+
+# files changed by a push, collapsed to their state at the after sha
+# a single compare call lists them, the commit lists of the payload are
+# used when the compare is unavailable or truncated
+# returns a {'filename', 'contents_url'} dict per file still present
+
+
+def push_changed_files(push):
+    before = push.get('before') or ''
+    after = push.get('after') or push['commits'][-1]['id']
+    files = None
+    if before.strip('0'):
+        compare = github_get(
+            github_url + '/compare/{}...{}'.format(before, after))
+        files = compare.get('files')
+        if files is not None and len(files) >= github_compare_max_files:
+            report_error(push_changed_files.__name__,
+                         'compare truncated', before, after)
+            files = None
+    if files is not None:
+        return [{'filename': f['filename'], 'contents_url': f['contents_url']}
+                for f in files if f['status'] != 'removed']
+
+    present = collections.OrderedDict()
+    for commit in push['commits']:
+        for filename in commit.get('added', []) + commit.get('modified', []):
+            present[filename] = True
+        for filename in commit.get('removed', []):
+            present[filename] = False
+    contents_url = github_url + '/contents/{}?ref=' + after
+    return [{'filename': filename,
+             'contents_url': contents_url.format(filename)}
+            for filename, exists in present.items() if exists]
+
+# retrieve a github blob by sha, blobs are not subject to the 1 MB limit
+# of the contents api
+
+
+def github_get_blob(sha):
+    return github_get(github_url + '/git/blobs/' + sha)
+
+# list every file under DITA/ with a single recursive tree call
+
+
+def load_dita_tree(ref='master'):
+    url = github_url + '/git/trees/{}:DITA?recursive=1'.format(ref)
+    tree = github_get(url)
+    if tree.get('truncated'):
+        # files missing from the listing fall back to the contents api
+        report_error(load_dita_tree.__name__, 'tree listing truncated', ref)
+    for entry in tree.get('tree', []):
+        if entry['type'] == 'blob':
+            dita_tree[entry['path']] = entry['sha']
+    log(load_dita_tree.__name__, ref, len(dita_tree))
+    return dita_tree
+
+# stream the repository tarball and keep every file under DITA/ in memory
+
+
+def load_dita_archive(ref='master'):
+    url = github_url + '/tarball/' + ref
+    with http_session(github_url).get(url=url, stream=True) as r:
+        r.raise_for_status()
+        archive = tarfile.open(fileobj=r.raw, mode='r|gz')
+        for member in archive:
+            if not member.isfile():
+                continue
+
+            # archive paths are prefixed with an <owner>-<repo>-<sha> folder
+            path = member.name.split('/', 1)[-1]
+            if path.startswith('DITA/'):
+                data = archive.extractfile(member).read()
+                dita_files[path[len('DITA/'):]] = data.decode('utf-8')
+                dita_shas[path[len('DITA/'):]] = git_blob_sha(data)
+        archive.close()
+    log(load_dita_archive.__name__, ref, len(dita_files))
+    return dita_files
+
+# retrieve the decoded contents of a file by its path relative to DITA/
+
+
+def get_dita_file(path):
+    path = path.lstrip('/')
+    if path in dita_files:
+        return dita_files[path]
+    sha = dita_tree.get(path)
+    if sha:
+        raw_json = github_get_blob(sha)
+    else:
+        raw_json = github_get(github_url + '/contents/DITA/' + path)
+        sha = raw_json.get('sha')
+
+        # files over 1 MB come back without content, fetch the blob instead
+        if not raw_json.get('content') and sha:
+            raw_json = github_get_blob(sha)
+    content = decode_content(raw_json['content'])
+    dita_shas[path] = sha
+    return content
+
+# returns the git blob sha of a file by its path relative to DITA/
+
+
+def dita_file_sha(path):
+    path = path.lstrip('/')
+    if path not in dita_shas:
+        get_dita_file(path)
+    return dita_shas[path]
+
+# git blob sha of raw file contents, as listed by the trees api
+
+
+def git_blob_sha(data):
+    header = 'blob {}\0'.format(len(data)).encode('utf-8')
+    return hashlib.sha1(header + data).hexdigest()
+
+# start fetching a batch of DITA files by their paths relative to DITA/
+
+
+def prefetch_dita_files(paths):
+    return [github_executor.submit(get_dita_file, path) for path in paths]
 
 # decode github file contents
 
@@ -663,27 +2202,30 @@ def decode_content(content):
 def zendesk_api_call(type, url, data=''):
     if 'http' not in url:
         url = zendesk_url + url
-    s = requests.Session()
-    s.auth = (zendesk_username, zendesk_password)
-    s.headers.update({"Content-Type": "application/json"})
+    s = http_session(zendesk_url)
     try:
         if type == 'GET':
-            r = requests_retry_session(sesssion=s).get(url=url)
+            r = zendesk_send(s.get, url=url)
             if 199 < r.status_code < 300:
                 return True, r
             else:
                 return False, r
         elif type == 'POST':
             data = json.dumps(data)
-            r = requests_retry_session(sesssion=s).post(url=url, data=data)
+            r = zendesk_send(s.post, url=url, data=data)
             if 199 < r.status_code < 300:
                 return True, r
             else:
                 return False, r
         elif type == 'PUT':
             data = json.dumps(data)
-            r = requests_retry_session(sesssion=s).put(url=url,
-                                                       data=data)
+            r = zendesk_send(s.put, url=url, data=data)
+            if 199 < r.status_code < 300:
+                return True, r
+            else:
+                return False, r
+        elif type == 'DELETE':
+            r = zendesk_send(s.delete, url=url)
             if 199 < r.status_code < 300:
                 return True, r
             else:
@@ -694,6 +2236,20 @@ def zendesk_api_call(type, url, data=''):
         log(str(e))
         return False, e
 
+# send a Zendesk request through the rate limiter, requests answered with
+# 429 are retried once the Retry-After delay has passed
+
+
+def zendesk_send(send, **kwargs):
+    for attempt in range(zendesk_max_attempts):
+        zendesk_rate_limiter.acquire()
+        r = send(**kwargs)
+        zendesk_rate_limiter.update(r)
+        if r.status_code != 429:
+            break
+        count_summary('zendesk_throttled')
+    return r
+
 # create a Zendesk article
 
 
@@ -711,13 +2267,13 @@ def create_zendesk_article(title, content, section_id):
     if success:
         j = json.loads(r.text)
         article_id = j['article']['id']
-        if section_id in article_map:
-            article_map[section_id][title] = article_id
-        else:
-            article_map[section_id] = {title: article_id}
+        record_published_body(article_id, content, j['article']['body'])
+        count_summary('articles_created')
+        article_map.setdefault(section_id, {})[title] = article_id
         log(create_zendesk_article.__name__, title, article_id)
         return article_id
     else:
+        count_summary('articles_failed')
         report_error(create_zendesk_article.__name__, r.status_code, r.text)
 
 # create a Zendesk section
@@ -739,10 +2295,7 @@ def create_zendesk_section(category_id, section_name):
         section = j['section']
         section_id = section['id']
         section_key = title_to_key(section_name)
-        if category_id in section_map:
-            section_map[category_id][section_key] = section_id
-        else:
-            section_map[category_id] = {section_key: section_id}
+        section_map.setdefault(category_id, {})[section_key] = section_id
         log(create_zendesk_section.__name__, section_key, section_id)
         return section_id
     else:
@@ -788,93 +2341,322 @@ def update_zendesk_article(title, content, article_id, locale="en-us"):
     if success:
         j = json.loads(r.text)
         translation_id = j['translation']['id']
+        record_published_body(article_id, content, j['translation']['body'])
+        count_summary('articles_updated')
         log(update_zendesk_article.__name__, title, translation_id)
         return translation_id
     else:
+        count_summary('articles_failed')
         report_error(update_zendesk_article.__name__, r.status_code, r.text)
 
+# move a Zendesk article to another section
+
+
+def move_zendesk_article(article_id, section_id):
+    url = '/api/v2/help_center/articles/{}.json'.format(article_id)
+    data = {"article": {"section_id": section_id}}
+    success, r = zendesk_api_call('PUT', url, data)
+    if success:
+        count_summary('articles_moved')
+        log(move_zendesk_article.__name__, article_id, section_id)
+        return article_id
+    else:
+        count_summary('articles_failed')
+        report_error(move_zendesk_article.__name__, r.status_code, r.text)
+
+# canonical fingerprint of an article body, insensitive to whitespace
+
+
+def body_fingerprint(body):
+    body = re.sub(r'>\s+<', '><', str(body or '').strip())
+    body = re.sub(r'\s+', ' ', body)
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+# remember what was sent to Zendesk and what Zendesk stored in return
+# Zendesk sanitizes article bodies, so the two fingerprints can differ
+
+
+def record_published_body(article_id, sent_body, stored_body):
+    stored = body_fingerprint(stored_body)
+    article_fingerprints[article_id] = stored
+    publish_records.set(str(article_id), {
+        'sent': body_fingerprint(sent_body), 'stored': stored})
+
+# check whether Zendesk already holds this body for an article
+# without the Zendesk catalog, the fingerprint of the last published body
+# from the sync state is trusted
+
+
+def is_article_unchanged(article_id, content, published=None):
+    fingerprint = body_fingerprint(content)
+    current = article_fingerprints.get(article_id)
+    if current == fingerprint:
+        return True
+    if current is None and published:
+        return published == fingerprint
+
+    # unchanged since our last write, and not edited in Zendesk since
+    record = publish_records.get(str(article_id))
+    return bool(record and current and record['sent'] == fingerprint and
+                record['stored'] == current)
+
+# count an event in the summary returned by the handler
+
+
+def count_summary(key, n=1):
+    with summary_lock:
+        run_summary[key] += n
+
 # retrieve all Zendesk articles
+# the listing streams, pages are only requested as far as callers iterate
 
 
 def list_zendesk_articles(locale="en-us"):
-    url = '/api/v2/help_center/{}/articles.json'.format(locale)
-    articles = []
+    return LazyListing(stream_zendesk_articles(locale))
+
+
+list_zendesk_articles = Memoize(list_zendesk_articles)
+
+# yield the compact record of every Zendesk article
+# the catalog is kept on disk and brought up to date with the incremental
+# export, only articles changed since the last sync are downloaded
+
+
+def stream_zendesk_articles(locale="en-us", parallel=False):
+    key = zendesk_catalog_key(locale)
+    catalog = zendesk_catalog_cache.get(key)
+    now = int(time.time())
+    if not catalog or now - catalog['rebuilt_at'] > zendesk_catalog_max_age:
+
+        # rebuild from the full listing, later runs export changes from here
+        catalog = {'start_time': now, 'rebuilt_at': now, 'articles': {}}
+        url = '/api/v2/help_center/{}/articles.json'.format(locale)
+        complete = False
+        for j in zendesk_pages(url, parallel):
+            for a in j['articles']:
+                yield index_zendesk_article(catalog, compact_article(a))
+            complete = is_last_page(j)
+        if not complete:
+            return
+    else:
+        changed = set()
+        for a in zendesk_article_changes(catalog, locale):
+            changed.add(str(a['id']))
+            yield index_zendesk_article(catalog, compact_article(a))
+        for article_id, a in list(catalog['articles'].items()):
+            if article_id not in changed:
+                yield index_zendesk_article(catalog, a)
+
+    with zendesk_catalog_lock:
+        zendesk_catalog_cache.set(key, catalog)
+    log(stream_zendesk_articles.__name__, len(catalog['articles']))
+
+# yield the articles changed since the catalog was last synced
+
+
+def zendesk_article_changes(catalog, locale="en-us"):
+    url = '/api/v2/help_center/incremental/articles.json?start_time={}'
+    url = url.format(catalog['start_time'])
     while url:
         success, r = zendesk_api_call('GET', url)
-        if success:
-            j = json.loads(r.text)
-            articles.extend(j['articles'])
-            url = j['next_page']
-        else:
-            report_error(list_zendesk_articles.__name__, r.status_code, r.text)
+        if not success:
+            report_error(zendesk_article_changes.__name__, r.status_code,
+                         r.text)
             break
-    for a in articles:
-        article_id = a['id']
-        section_id = a['section_id']
-        article_title = a['title']
-        if section_id in article_map:
-            article_map[section_id][article_title] = article_id
+        j = json.loads(r.text)
+        for a in j['articles']:
+            if a.get('locale', locale) == locale:
+                yield a
+
+        # the export is complete once a page brings nothing newer
+        end_time = j.get('end_time')
+        if not j['articles'] or not end_time or \
+                end_time <= catalog['start_time']:
+            url = None
         else:
-            article_map[section_id] = {article_title: article_id}
-    return articles
+            catalog['start_time'] = end_time
+            url = j.get('next_page')
 
+# store an article record in the catalog and the lookup maps
+
+
+def index_zendesk_article(catalog, a):
+    catalog['articles'][str(a['id'])] = a
+    article_map.setdefault(a['section_id'], {})[a['title']] = a['id']
+    article_fingerprints[a['id']] = a['body_hash']
+    return a
+
+# keep the fields of a Zendesk article the sync relies on
 
-list_zendesk_articles = Memoize(list_zendesk_articles)
+
+def compact_article(a):
+    return {'id': a['id'], 'title': a['title'],
+            'section_id': a['section_id'], 'updated_at': a.get('updated_at'),
+            'body_hash': body_fingerprint(a.get('body'))}
+
+# key of the stored article catalog of a locale
+
+
+def zendesk_catalog_key(locale="en-us"):
+    return 'articles:{}:{}'.format(zendesk_url, locale)
+
+# drop a deleted item from the stored article catalog
+# deleting a category or section also deletes its articles, the catalog is
+# then rebuilt from scratch on the next run
+
+
+def forget_zendesk_item(obj_type, id, locale="en-us"):
+    with zendesk_catalog_lock:
+        key = zendesk_catalog_key(locale)
+        catalog = zendesk_catalog_cache.get(key)
+        if not catalog:
+            return
+        if obj_type == 'articles':
+            catalog['articles'].pop(str(id), None)
+        else:
+            catalog['rebuilt_at'] = 0
+        zendesk_catalog_cache.set(key, catalog)
 
 # retrieve all Zendesk sections
 
 
 def list_zendesk_sections(locale="en-us"):
-    url = '/api/v2/help_center/{}/sections.json'.format(locale)
-    sections = []
-    while url:
-        success, r = zendesk_api_call('GET', url)
-        if success:
-            j = json.loads(r.text)
-            sections.extend(j['sections'])
-            url = j['next_page']
-        else:
-            report_error(list_zendesk_sections.__name__, r.status_code, r.text)
-            break
-    for s in sections:
-        section_id = s['id']
-        category_id = s['category_id']
-        section_name = s['name']
-        section_key = title_to_key(section_name)
-        if category_id in section_map:
-            section_map[category_id][section_key] = section_id
-        else:
-            section_map[category_id] = {section_key: section_id}
-    return sections
+    return LazyListing(stream_zendesk_sections(locale))
 
 
 list_zendesk_sections = Memoize(list_zendesk_sections)
 
+# yield the compact record of every Zendesk section
+
+
+def stream_zendesk_sections(locale="en-us", parallel=False):
+    url = '/api/v2/help_center/{}/sections.json'.format(locale)
+    for j in zendesk_pages(url, parallel):
+        for s in j['sections']:
+            section_key = title_to_key(s['name'])
+            section_map.setdefault(s['category_id'], {})[section_key] = s['id']
+            yield {'id': s['id'], 'name': s['name'],
+                   'category_id': s['category_id']}
+
 # retrieve all Zendesk categories
 
 
 def list_zendesk_categories(locale="en-us"):
+    return LazyListing(stream_zendesk_categories(locale))
+
+
+list_zendesk_categories = Memoize(list_zendesk_categories)
+
+# yield the compact record of every Zendesk category
+
+
+def stream_zendesk_categories(locale="en-us", parallel=False):
     url = '/api/v2/help_center/{}/categories.json'.format(locale)
-    categories = []
+    for j in zendesk_pages(url, parallel):
+        for c in j['categories']:
+            category_map[title_to_key(c['name'])] = c['id']
+            yield {'id': c['id'], 'name': c['name']}
+
+# fetch the category, section and article listings concurrently
+# the pages of each listing are requested in parallel, the lookup maps are
+# complete once it returns
+
+
+def warm_zendesk_catalog():
+    started = time.time()
+    listings = ((list_zendesk_categories, stream_zendesk_categories),
+                (list_zendesk_sections, stream_zendesk_sections),
+                (list_zendesk_articles, stream_zendesk_articles))
+    for listing, stream in listings:
+        listing.prime((), LazyListing(stream(parallel=True)))
+    with ThreadPoolExecutor(max_workers=len(listings)) as executor:
+        counts = list(executor.map(
+            lambda listing: sum(1 for _ in listing[0]()), listings))
+    elapsed_ms = int((time.time() - started) * 1000)
+    count_summary('zendesk_warmup_ms', elapsed_ms)
+    log(warm_zendesk_catalog.__name__, counts, elapsed_ms)
+
+# yield the pages of a Zendesk listing
+# cursor pagination with the largest page size, the next page is only
+# requested once the previous one has been consumed
+# parallel listings use offset pagination to request every page at once
+
+
+def zendesk_pages(url, parallel=False):
+    if parallel:
+        for j in zendesk_offset_pages(url):
+            yield j
+        return
+    url = '{}?page[size]={}'.format(url, zendesk_page_size)
     while url:
         success, r = zendesk_api_call('GET', url)
-        if success:
-            j = json.loads(r.text)
-            categories.extend(j['categories'])
-            url = j['next_page']
-        else:
-            report_error(
-                list_zendesk_categories.__name__,
-                r.status_code,
-                r.text)
-            break
-    for c in categories:
-        category_key = title_to_key(c['name'])
-        category_map[category_key] = c['id']
-    return categories
+        if not success:
+            report_error(zendesk_pages.__name__, url, r.status_code, r.text)
+            return
+        j = json.loads(r.text)
+        yield j
+        url = j['links']['next'] if j['meta']['has_more'] else None
 
+# yield the pages of a Zendesk listing in order
+# the first page tells the page count, the others are fetched concurrently
 
-list_zendesk_categories = Memoize(list_zendesk_categories)
+
+def zendesk_offset_pages(url):
+    page_url = '{}?per_page={}&page={{}}'.format(url, zendesk_page_size)
+    success, r = zendesk_api_call('GET', page_url.format(1))
+    if not success:
+        report_error(zendesk_offset_pages.__name__, url, r.status_code, r.text)
+        return
+    j = json.loads(r.text)
+    futures = [zendesk_executor.submit(zendesk_api_call, 'GET',
+                                       page_url.format(page))
+               for page in range(2, j.get('page_count', 1) + 1)]
+    yield j
+    for page, f in enumerate(futures, 2):
+        success, r = f.result()
+        if not success:
+            report_error(zendesk_offset_pages.__name__, url, page,
+                         r.status_code, r.text)
+            for f in futures:
+                f.cancel()
+            return
+        yield json.loads(r.text)
+
+# whether a listing page is the last one, for cursor and offset pagination
+
+
+def is_last_page(j):
+    if 'meta' in j:
+        return not j['meta']['has_more']
+    return not j.get('next_page')
+
+# a listing that is read once and replayed to every later caller
+# records are pulled from the source only as far as a caller iterates, a
+# lookup stops paging as soon as it finds its match
+
+
+class LazyListing:
+    def __init__(self, records):
+        self.records = records
+        self.seen = []
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        i = 0
+        while True:
+            with self.lock:
+                if i == len(self.seen):
+                    if self.exhausted:
+                        return
+                    try:
+                        self.seen.append(next(self.records))
+                    except StopIteration:
+                        self.exhausted = True
+                        return
+                record = self.seen[i]
+            i += 1
+            yield record
 
 # returns Zendesk article id
 
@@ -917,44 +2699,280 @@ def zendesk_category_id(category_name):
 
 
 def title_to_key(title):
-    return title.strip().replace(' ', '_').lower()
+    return '_'.join(title.split()).lower()
 
-# creates categories,sections,articles
+# returns the Zendesk category id, the category is created when missing
+# concurrent callers wait for a single lookup or creation
 
 
-def create_or_update_zendesk_article(
-        category_name,
-        section_name,
-        article_title,
-        article_content):
+def get_or_create_zendesk_category(category_name):
+    with single_flight(('category', title_to_key(category_name))):
+
+        # search for the category
+        category_id = zendesk_category_id(category_name)
+
+        if not category_id:
+
+            # create the category
+            category_id = create_zendesk_category(category_name)
+
+        return category_id
 
-    # search for the category the section should be in
-    category_id = zendesk_category_id(category_name)
+# returns the Zendesk section id, the section is created when missing
+# concurrent callers wait for a single lookup or creation
 
-    if not category_id:
 
-        # create the category
-        category_id = create_zendesk_category(category_name)
+def get_or_create_zendesk_section(category_id, section_name):
+    with single_flight(('section', category_id, title_to_key(section_name))):
 
-    # search for the section it should be in
-    section_id = zendesk_section_id(category_id, section_name)
+        # search for the section
+        section_id = zendesk_section_id(category_id, section_name)
 
-    if not section_id:
+        if not section_id:
 
-        # create the section
-        section_id = create_zendesk_section(category_id, section_name)
+            # create the section
+            section_id = create_zendesk_section(category_id, section_name)
+
+        return section_id
+
+# returns the lock shared by every caller working on the same key
 
-    # search for the existing article
-    article_id = zendesk_article_id(section_id, article_title)
 
-    if article_id:
+def single_flight(key):
+    with single_flight_lock:
+        return single_flight_locks.setdefault(key, threading.Lock())
+
+# creates categories,sections,articles
+# returns the outcome ('created', 'updated', 'moved', 'skipped' or
+# 'failed') and the article id
 
-        # update the article with this new content
-        update_zendesk_article(article_title, article_content, article_id)
 
+def create_or_update_zendesk_article(
+        category_name,
+        section_name,
+        article_title,
+        article_content,
+        article_href=None):
+    return apply_zendesk_article(plan_zendesk_article(
+        category_name, section_name, article_title, article_content,
+        article_href))
+
+# plan the Zendesk writes of a batch of (category, section, title, html,
+# href) upserts, the given deletes and, given the ditamap, the deletes of
+# unmapped items
+# nothing is written, categories and sections missing from Zendesk are
+# planned as creates, the last upsert of an article wins
+
+
+def plan_zendesk_sync(upserts, ditamap=None, deletes=()):
+    plan = {'categories': [], 'sections': [], 'articles': [],
+            'deletes': list(deletes)}
+    latest = collections.OrderedDict()
+    for u in upserts:
+        key = u[4] if len(u) > 4 and u[4] else \
+            (title_to_key(u[0]), title_to_key(u[1]), u[2].lower())
+        latest.pop(key, None)
+        latest[key] = u
+
+    categories = set()
+    sections = set()
+    for u in latest.values():
+        action = plan_zendesk_article(*u)
+        category_key = title_to_key(action['category'])
+        section_key = (category_key, title_to_key(action['section']))
+        if not action['category_id'] and category_key not in categories:
+            categories.add(category_key)
+            plan['categories'].append(action['category'])
+        if not action['section_id'] and section_key not in sections:
+            sections.add(section_key)
+            plan['sections'].append((action['category'], action['section']))
+        plan['articles'].append(action)
+
+    if ditamap:
+        # moved articles leave their old section before it is deleted
+        kept = set(('articles', a['article_id']) for a in plan['articles']
+                   if a['article_id'])
+        plan['deletes'].extend(d for d in reconcile_zendesk(ditamap)
+                               if d not in plan['deletes'])
+        plan['deletes'] = [d for d in plan['deletes'] if d not in kept]
+    plan['api_calls'] = estimate_api_calls(plan)
+    return plan
+
+# plan the write of a single article, returns the action to apply
+# 'create', 'update', 'move' (to another section) or 'skip'
+# an article published before is found through the sync state by its href,
+# it keeps its Zendesk article when renamed or moved
+
+
+def plan_zendesk_article(
+        category_name,
+        section_name,
+        article_title,
+        article_content,
+        article_href=None):
+    action = {'category': category_name, 'section': section_name,
+              'title': article_title, 'content': article_content,
+              'href': article_href, 'published': None}
+    state = sync_state.get(article_href) if article_href else None
+    category_key = title_to_key(category_name)
+    section_key = title_to_key(section_name)
+    if state and (state['category_key'], state['section_key']) == \
+            (category_key, section_key):
+
+        # the href was last published under the same category and section
+        category_id = state['category_id']
+        section_id = state['section_id']
+        article_id = state['article_id']
+        action['published'] = state['content_hash']
+    else:
+
+        # search for the category, section and article by name
+        category_id = zendesk_category_id(category_name)
+        section_id = category_id and zendesk_section_id(category_id,
+                                                        section_name)
+        article_id = section_id and zendesk_article_id(section_id,
+                                                       article_title)
+
+        # the href was published under another section, move its article
+        if not article_id and state and state['article_id']:
+            action['action'] = 'move'
+            article_id = state['article_id']
+    action.update(category_id=category_id or None,
+                  section_id=section_id or None,
+                  article_id=article_id or None)
+
+    if 'action' in action:
+        action['changed'] = not is_article_unchanged(
+            article_id, article_content, state['content_hash'])
+    elif not article_id:
+        action['action'] = 'create'
+    elif is_article_unchanged(article_id, article_content,
+                              action['published']):
+        action['action'] = 'skip'
     else:
+        action['action'] = 'update'
+    return action
+
+# apply a planned article action, missing categories and sections are
+# looked up or created first
+# returns the outcome ('created', 'updated', 'moved', 'skipped', 'failed'
+# or, past a shard's deadline, 'deferred') and the article id
+
+
+def apply_zendesk_article(action):
+    category_id = action['category_id'] or \
+        get_or_create_zendesk_category(action['category'])
+    section_id = action['section_id'] or (
+        category_id and get_or_create_zendesk_section(category_id,
+                                                      action['section']))
+    if not category_id or not section_id:
+        report_error(apply_zendesk_article.__name__,
+                     'missing category or section', action['category'],
+                     action['section'])
+        count_summary('articles_failed')
+        return 'failed', None
+
+    title = action['title']
+    content = action['content']
+    article_id = action['article_id']
+    if action['action'] != 'skip' and past_run_deadline():
+        count_summary('articles_deferred')
+        return 'deferred', article_id
+
+    status = 'failed'
+    if action['action'] == 'skip':
+        count_summary('articles_skipped')
+        status = 'skipped'
+
+    elif action['action'] == 'update':
+        if update_zendesk_article(title, content, article_id):
+            status = 'updated'
+
+    elif action['action'] == 'move':
+        if move_zendesk_article(article_id, section_id) and (
+                not action['changed'] or
+                update_zendesk_article(title, content, article_id)):
+            status = 'moved'
 
+    else:
         # create the article in Zendesk under this section
-        create_zendesk_article(article_title, article_content, section_id)
+        article_id = create_zendesk_article(title, content, section_id)
+        if article_id:
+            status = 'created'
+
+    href = action['href']
+    if href and status != 'failed':
+        sync_state.put(href, category_key=title_to_key(action['category']),
+                       category_id=category_id,
+                       section_key=title_to_key(action['section']),
+                       section_id=section_id, article_id=article_id,
+                       title=title, content_hash=body_fingerprint(content),
+                       blob_sha=dita_shas.get(href))
+
+    # the stored article may be gone, look it up by title next time
+    elif href and article_id:
+        sync_state.forget(href)
+    return status, article_id
+
+# number of Zendesk requests needed to apply a plan
+
+
+def estimate_api_calls(plan):
+    calls = len(plan['categories']) + len(plan['sections']) + \
+        len(plan['deletes'])
+    for a in plan['articles']:
+        if a['action'] in ('create', 'update'):
+            calls += 1
+        elif a['action'] == 'move':
+            calls += 2 if a['changed'] else 1
+    return calls
+
+# json friendly outline of a plan, article bodies are left out
+
+
+def describe_sync_plan(plan):
+    articles = collections.defaultdict(list)
+    for a in plan['articles']:
+        articles[a['action']].append(
+            {'category': a['category'], 'section': a['section'],
+             'title': a['title'], 'href': a['href'], 'id': a['article_id']})
+    return {'categories': plan['categories'], 'sections': plan['sections'],
+            'articles': articles, 'deletes': plan['deletes'],
+            'api_calls': plan['api_calls']}
+
+# apply a plan, categories first, then sections, then articles, deletes
+# last, every stage runs in parallel
+# returns one result per planned article in order
+
+
+def execute_sync_plan(plan):
+    run_parallel(get_or_create_zendesk_category, plan['categories'])
+    run_parallel(lambda s: get_or_create_zendesk_section(
+        zendesk_category_id(s[0]), s[1]),
+        [s for s in plan['sections'] if zendesk_category_id(s[0])])
+
+    futures = [zendesk_executor.submit(apply_zendesk_article, a)
+               for a in plan['articles']]
+    results = []
+    for action, f in zip(plan['articles'], futures):
+        result = {'category': action['category'],
+                  'section': action['section'], 'title': action['title']}
+        try:
+            result['status'], result['id'] = f.result()
+        except Exception as e:
+            report_error(execute_sync_plan.__name__, action['title'], str(e))
+            count_summary('articles_failed')
+            result['status'], result['id'] = 'failed', None
+        results.append(result)
+
+    if plan['deletes']:
+        delete_zendesk_items(plan['deletes'])
+    return results
+
+# run a function over items on the Zendesk pool, results are returned in
+# order
+
 
-    # todo: add error logging to this function (e.g. if category not created)
+def run_parallel(f, items):
+    return [future.result() for future in
+            [zendesk_executor.submit(f, item) for item in items]]